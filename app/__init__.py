@@ -8,20 +8,23 @@ from flask import (
     url_for,
     flash,
     make_response,
+    send_from_directory,
+    abort,
+    g,
 )
 import os
 import io
-import random
+import json
 import logging
+import zipfile
 
-from PIL import Image
+from urllib.parse import parse_qsl
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
-from flask_caching import Cache
 from functools import wraps
 
-from app.utils.species_lookup import load_species_data
+from app.utils.species_lookup import load_species_data, registry
 from app.utils.calculate_heights import calculate_height_offset, convert_to_inches
 from app.utils.parse_data import (
     extract_characters,
@@ -32,38 +35,167 @@ from app.utils.parse_data import (
     get_default_characters,
 )
 from app.utils.stats import StatsManager
-from app.utils.generate_image import render_image
+from app.utils.encode import negotiate_format, mimetype_for, extension_for
+from app.utils.sprite_cache import (
+    ART_ROOT,
+    DIST_ROOT,
+    art_revision,
+    sprite_cache,
+    layer_cache,
+)
+from app.utils.metrics import metrics
+from app.utils.render_queue import RenderScheduler, QueueFull
+from app.utils.render_cache import RenderCache
+from app.utils.layout import compute_layout
+from app.utils.generate_image import label_cache
+from app.utils.permalinks import PermalinkStore, PERMALINK_SIZE
+from app.utils.cache_warmer import CacheWarmer
+from app.utils.render_params import RenderParams
+from app.utils.svg import SPRITE_URL_PREFIX
 from app.utils.character import Character
+from render_worker import render_spec, warm_render_process
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 stats_manager = StatsManager("/var/size-diff/stats.db")
-executor = ThreadPoolExecutor(max_workers=4)
-
-# Cache
-cache = Cache(app, config={"CACHE_TYPE": "simple"})
-cache_stats = {"hits": 0, "misses": 0}
-
-
-def cache_with_stats(timeout, query_string=False):
-    """Track cache performance while caching responses."""
-
-    def decorator(f):
-        @wraps(f)
-        def wrapped(*args, **kwargs):
-            cache_key = f"{request.path}?{request.query_string.decode('utf-8')}"
-            cached_response = cache.get(cache_key)
-            if cached_response:
-                cache_stats["hits"] += 1
-                return cached_response
-            cache_stats["misses"] += 1
-            response = f(*args, **kwargs)
-            cache.set(cache_key, response, timeout=timeout)
+scheduler = RenderScheduler(initializer=warm_render_process)
+
+# How long a request waits for its render, and how long a turned away client should back off
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "30"))
+RENDER_RETRY_AFTER = int(os.getenv("RENDER_RETRY_AFTER", "5"))
+
+# Most renders accepted in one /api/render-batch call
+RENDER_BATCH_LIMIT = int(os.getenv("RENDER_BATCH_LIMIT", "100"))
+
+# Cache, shared on disk between every worker
+render_cache = RenderCache()
+
+# Short links to lineups, each with its image rendered once
+permalinks = PermalinkStore()
+
+
+def collect_cache_metrics(m):
+    """Copies cache counters kept by the caches themselves into the metrics snapshot."""
+    m.set_counter("render_cache_evictions_total", render_cache.evictions)
+    m.set_counter("render_cache_errors_total", render_cache.errors)
+    for name, image_cache in (
+        ("sprite", sprite_cache),
+        ("layer", layer_cache),
+        ("label", label_cache),
+    ):
+        cache_info = image_cache.stats()
+        m.set_counter("image_cache_hits_total", cache_info["hits"], cache=name)
+        m.set_counter("image_cache_misses_total", cache_info["misses"], cache=name)
+        m.set_counter(
+            "image_cache_evictions_total", cache_info["evictions"], cache=name
+        )
+        m.set_gauge("image_cache_bytes", cache_info["bytes"], cache=name)
+
+
+metrics.register_collector(collect_cache_metrics)
+
+
+def content_revision() -> str:
+    """Revision of everything a render depends on besides its parameters."""
+    return f"{os.getenv('GIT_COMMIT', '')}:{registry.revision()}:{art_revision()}"
+
+
+# Keeps the default scene and preset lineups rendered ahead of visitors
+cache_warmer = CacheWarmer(render_cache, scheduler, content_revision)
+
+
+@app.before_request
+def start_cache_warmer():
+    # Started lazily, so it runs in every worker but never in a pre-fork master
+    cache_warmer.start()
+
+
+def sprite_url_prefix() -> str:
+    """Where SVGs link sprites: SPRITE_URL_PREFIX, else this host's /sprites/ as an absolute URL."""
+    return SPRITE_URL_PREFIX or f"{request.url_root}sprites/"
+
+
+def render_job(params: RenderParams, fmt: str):
+    """
+    The render cache key and picklable render spec of one image. SVGs link
+    their sprites by absolute URL, so the prefix is part of both.
+    """
+    if fmt == "svg":
+        prefix = sprite_url_prefix()
+        return (
+            params.cache_key(f"{content_revision()}:{prefix}", fmt),
+            (params.query_string(), fmt, prefix),
+        )
+    return params.cache_key(content_revision(), fmt), (params.query_string(), fmt)
+
+
+def image_response(data: bytes, fmt="png", etag=None):
+    """Wraps encoded image bytes in a long-lived, cacheable response."""
+    response = make_response(data)
+    response.headers.set("Content-Type", mimetype_for(fmt))
+    response.headers.set(
+        "Content-Disposition", "inline", filename=f"preview.{extension_for(fmt)}"
+    )
+    response.headers.set("Cache-Control", "public, max-age=31536000")
+    if etag:
+        response.set_etag(etag)
+    if g.render_params.format is None:
+        # Format was negotiated, so caches have to key on Accept too
+        response.vary.add("Accept")
+    return response
+
+
+def canonical_render_params(f):
+    """
+    Parse the request into the exact parameters that reach the renderer.
+    Non-canonical URLs (reordered args, clamped sizes, 62.0 vs 62, ...) are
+    redirected to the canonical one so every alias shares a single cache entry.
+    """
+
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        params = RenderParams.from_args(request.args)
+        canonical_query = params.query_string()
+        if request.query_string.decode("utf-8") != canonical_query:
+            return redirect(f"{request.path}?{canonical_query}", code=301)
+
+        g.render_params = params
+        g.image_format = params.format or negotiate_format(request.accept_mimetypes)
+        return f(*args, **kwargs)
+
+    return wrapped
+
+
+def cache_with_stats(f):
+    """
+    Serve rendered images from the render cache, tracking cache performance.
+    The cache key doubles as a strong ETag, so revalidations are answered
+    with a 304 before touching the cache or the renderer.
+    """
+
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        cache_key, g.render_spec = render_job(g.render_params, g.image_format)
+        g.cache_key = cache_key
+        if request.if_none_match.contains(cache_key):
+            response = image_response(b"", g.image_format, etag=cache_key)
+            response.status_code = 304
             return response
 
-        return wrapped
+        cached_data = render_cache.get(cache_key)
+        if cached_data is not None:
+            metrics.inc("render_cache_hits_total")
+            return image_response(cached_data, g.image_format, etag=cache_key)
+        metrics.inc("render_cache_misses_total")
+        response = make_response(f(*args, **kwargs))
+        if response.status_code == 200:
+            # Placeholders are memoized in-process, keep them out of the shared budget
+            if g.render_params.characters:
+                render_cache.put(cache_key, response.get_data())
+            response.set_etag(cache_key)
+        return response
 
-    return decorator
+    return wrapped
 
 
 # Sets up logging
@@ -82,68 +214,267 @@ species_list = [
 
 
 @app.route("/generate-image")
-@cache_with_stats(timeout=31536000, query_string=True)
+@canonical_render_params
+@cache_with_stats
 def generate_image():
-    # Get characters
-    characters = request.args.get("characters", "")
-    characters_list = extract_characters(characters)
-
-    # Get settings
-    measure_ears = request.args.get("measure_ears", True) == "True"
-    scale_height = request.args.get("scale_height", True) == "True"
-
-    # Get height
-    size = int(request.args.get("size", "400"))
+    params = g.render_params
+    image_format = g.image_format
 
     # Record we've generated a new image!
     stats_manager.increment_images_generated()
 
-    def generate_and_save():
-        if len(characters_list) == 0:
-            logging.warn("Asked to generate an empty image!")
-
-            # Generate an empty image
-            image = Image.new("RGB", (int(size * 1.4), size))
-            pixels = image.load()
-
-            for i in range(image.size[0]):
-                for j in range(image.size[1]):
-                    pixels[i, j] = (
-                        random.randint(0, 255),
-                        random.randint(0, 255),
-                        random.randint(0, 255),
-                    )
-        else:
-            image = render_image(
-                characters_list,
-                size,
-                measure_to_ears=measure_ears,
-                use_species_scaling=scale_height,
-            )
+    # Queue the render, sharing it with identical requests already in flight
+    try:
+        img_data = scheduler.render(
+            g.cache_key, render_spec, g.render_spec, timeout=RENDER_TIMEOUT
+        )
+    except QueueFull:
+        response = make_response("Too many images being generated, try again soon", 503)
+        response.headers.set("Retry-After", str(RENDER_RETRY_AFTER))
+        return response
+    except FutureTimeoutError:
+        return "Image generation timed out", 504
 
-        # Save image to a BytesIO object
-        img_io = io.BytesIO()
-        image.save(img_io, "PNG")
-        img_io.seek(0)
-        return img_io
+    return image_response(img_data, image_format)
 
-    # Submit the task to the executor
-    future = executor.submit(generate_and_save)
 
-    try:
-        img_io = future.result(timeout=30)  # Wait for up to 30 seconds
-    except TimeoutError:
-        return "Image generation timed out", 504
+@app.route("/sprites/<path:rel_path>")
+def sprite(rel_path):
+    """
+    Serves character art for SVG renders, trimmed copy first. URLs carry the
+    art's mtime, so responses can be cached forever.
+    """
+    for root in (DIST_ROOT, ART_ROOT):
+        if os.path.isfile(os.path.join(root, rel_path)):
+            response = send_from_directory(os.path.abspath(root), rel_path)
+            response.headers.set("Cache-Control", "public, max-age=31536000, immutable")
+            return response
+    abort(404)
+
 
-    # Create a response with the image and set Content-Type to image/png
-    response = make_response(img_io.read())
-    response.headers.set("Content-Type", "image/png")
-    response.headers.set("Content-Disposition", "inline", filename="preview.png")
+@app.route("/api/layout")
+def layout():
+    """
+    The geometry /generate-image would draw, as JSON: heights, scale factors,
+    pixel boxes and guideline positions. Takes the same arguments, and never
+    decodes or rasterizes anything.
+    """
+    params = RenderParams.from_args(request.args)
+    if len(params.characters) == 0:
+        return jsonify(error="No characters given"), 400
+
+    etag = params.cache_key(content_revision(), "layout")
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        metrics.inc("layouts_total")
+        response = jsonify(
+            compute_layout(
+                params.characters,
+                params.size,
+                measure_to_ears=params.measure_ears,
+                use_species_scaling=params.scale_height,
+            ).to_dict()
+        )
+    response.set_etag(etag)
     response.headers.set("Cache-Control", "public, max-age=31536000")
+    return response
+
+
+@app.route("/api/render-batch", methods=["POST"])
+def render_batch():
+    """
+    Render many comparisons in one call. Takes a JSON list of render specs
+    (characters, size, measure_ears, scale_height, optional format) and
+    returns a zip with one image per spec plus a manifest.json.
+    """
+    specs = request.get_json(silent=True)
+    if isinstance(specs, dict):
+        specs = specs.get("renders")
+    if not isinstance(specs, list) or not specs:
+        return jsonify(error="Expected a JSON list of render specs"), 400
+    if len(specs) > RENDER_BATCH_LIMIT:
+        return jsonify(error=f"At most {RENDER_BATCH_LIMIT} renders per batch"), 400
+
+    try:
+        batch = [RenderParams.from_json(spec) for spec in specs]
+    except (AttributeError, TypeError, ValueError) as e:
+        return jsonify(error=f"Invalid render spec: {e}"), 400
+
+    jobs = [render_job(params, params.format or "png") for params in batch]
+    rendered = {}  # cache key -> image bytes
+    flights = {}  # cache key -> Flight, in submission order
+    landing = None  # cache key of the render being waited for
+
+    def _land_oldest():
+        nonlocal landing
+        landing = next(iter(flights))
+        data = scheduler.wait(flights.pop(landing), timeout=RENDER_TIMEOUT)
+        render_cache.put(landing, data)
+        rendered[landing] = data
+        landing = None
+
+    # Serve what the cache already has, queue everything else at once so it renders in parallel
+    try:
+        for cache_key, spec in jobs:
+            if cache_key in rendered or cache_key in flights:
+                continue
+            cached_data = render_cache.get(cache_key)
+            if cached_data is not None:
+                metrics.inc("render_cache_hits_total")
+                rendered[cache_key] = cached_data
+                continue
+
+            metrics.inc("render_cache_misses_total")
+            while True:
+                try:
+                    flights[cache_key] = scheduler.submit(cache_key, render_spec, spec)
+                    break
+                except QueueFull:
+                    # Make room by collecting our own renders, only give up if none are queued
+                    if not flights:
+                        raise
+                    _land_oldest()
+            stats_manager.increment_images_generated()
+
+        while flights:
+            _land_oldest()
+    except QueueFull:
+        response = jsonify(error="Too many images being generated, try again soon")
+        response.status_code = 503
+        response.headers.set("Retry-After", str(RENDER_RETRY_AFTER))
+        return response
+    except FutureTimeoutError:
+        return jsonify(error="Image generation timed out"), 504
+    except Exception as e:
+        # One bad spec (a zero height, ...) fails the batch, say which
+        index = next((i for i, job in enumerate(jobs) if job[0] == landing), None)
+        logging.exception(f"Batch render of spec {index} failed")
+        return jsonify(error=f"Rendering failed: {e}", spec=index), 500
+    finally:
+        # Renders this batch never waited for would otherwise keep the workers busy
+        for flight in flights.values():
+            scheduler.release(flight)
+
+    zip_io = io.BytesIO()
+    manifest = []
+    with zipfile.ZipFile(zip_io, "w", zipfile.ZIP_STORED) as archive:
+        for i, (params, (cache_key, _)) in enumerate(zip(batch, jobs)):
+            filename = f"{i:04d}.{extension_for(params.format or 'png')}"
+            # Images are already compressed, storing them is as small and much faster
+            archive.writestr(filename, rendered[cache_key])
+            manifest.append(
+                {
+                    "file": filename,
+                    "url": f"{url_for('generate_image')}?{params.query_string()}",
+                    "etag": cache_key,
+                }
+            )
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+
+    response = make_response(zip_io.getvalue())
+    response.headers.set("Content-Type", "application/zip")
+    response.headers.set(
+        "Content-Disposition", "attachment", filename="render-batch.zip"
+    )
+    return response
+
+
+def index_url(params: RenderParams) -> str:
+    """The calculator page showing a lineup, in the index's own query format."""
+    settings_query = f"&measure_ears=false" if not params.measure_ears else ""
+    settings_query += f"&scale_height=true" if params.scale_height else ""
+    return f"/?characters={params.characters_query()}{settings_query}"
+
 
+@app.route("/s/<link_id>")
+def permalink(link_id):
+    query = permalinks.get(link_id)
+    if query is None:
+        abort(404)
+    params = RenderParams.from_args(dict(parse_qsl(query, keep_blank_values=True)))
+    # Tells the page it was opened from this link, so it shows and previews it
+    return redirect(f"{index_url(params)}&link={link_id}")
+
+
+@app.route("/share", methods=["POST"])
+def share():
+    """
+    Stores a permalink for a lineup and opens it. Links are only made when a
+    visitor asks for one, never for a page view, so crawlers don't add any.
+    """
+    params = RenderParams.from_args(
+        dict(parse_qsl(request.form.get("query", ""), keep_blank_values=True))
+    )
+    if not params.characters:
+        abort(400)
+
+    link_id = permalinks.create(
+        RenderParams(
+            params.characters, PERMALINK_SIZE, params.measure_ears, params.scale_height
+        ).query_string()
+    )
+    return redirect(url_for("permalink", link_id=link_id), code=303)
+
+
+@app.route("/s/<link_id>.png")
+def permalink_image(link_id):
+    """
+    A permalink's image. Rendered on the first request and stored next to the
+    link, every request after that is an indexed lookup and a file send. Art
+    or species data changes move the content revision, and it's rendered again.
+    """
+    query = permalinks.get(link_id)
+    if query is None:
+        abort(404)
+
+    revision = content_revision()
+    image_path = permalinks.image_path(link_id, revision)
+    if not os.path.exists(image_path):
+        params = RenderParams.from_args(dict(parse_qsl(query, keep_blank_values=True)))
+        cache_key = params.cache_key(revision, "png")
+        img_data = render_cache.get(cache_key)
+        if img_data is None:
+            stats_manager.increment_images_generated()
+            try:
+                img_data = scheduler.render(
+                    cache_key, render_spec, (query, "png"), timeout=RENDER_TIMEOUT
+                )
+            except QueueFull:
+                response = make_response(
+                    "Too many images being generated, try again soon", 503
+                )
+                response.headers.set("Retry-After", str(RENDER_RETRY_AFTER))
+                return response
+            except FutureTimeoutError:
+                return "Image generation timed out", 504
+            render_cache.put(cache_key, img_data)
+        permalinks.save_image(link_id, revision, img_data)
+
+        if not os.path.exists(image_path):
+            # Couldn't store it, still answer this request
+            response = make_response(img_data)
+            response.headers.set("Content-Type", "image/png")
+            return response
+
+    return send_file(image_path, mimetype="image/png", max_age=31536000)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    response = make_response(metrics.render())
+    response.headers.set("Content-Type", "text/plain; version=0.0.4")
     return response
 
 
+def cache_performance() -> str:
+    """Render cache hits/misses across every worker, for the footer."""
+    counters = metrics.aggregate(fresh=False)["counters"]
+    hits = counters.get(("render_cache_hits_total", ()), 0)
+    misses = counters.get(("render_cache_misses_total", ()), 0)
+    return f"{hits}/{misses}"
+
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     species = species_list  # Assuming species_list is defined elsewhere
@@ -218,10 +549,28 @@ def index():
     settings_query = f"&measure_ears=false" if not measure_ears else ""
     settings_query += f"&scale_height=true" if scale_height else ""
 
+    # The lineup as a permalink stores it, only made into one through /share
+    share_query = RenderParams(
+        characters_list, PERMALINK_SIZE, measure_ears, scale_height
+    ).query_string()
+
+    # Opened from a short link, show it and preview its stored image
+    permalink_id = request.args.get("link")
+    if permalink_id and permalinks.get(permalink_id) != share_query:
+        permalink_id = None  # Unknown, or for a different lineup
+    if permalink_id:
+        og_image_url = url_for("permalink_image", link_id=permalink_id, _external=True)
+    else:
+        og_image_url = f"{url_for('generate_image', _external=True)}?{share_query}"
+
     return render_template(
         "index.html",
+        render_params=RenderParams(characters_list, 1024, measure_ears, scale_height),
+        permalink_id=permalink_id,
+        share_query=share_query,
+        og_image_url=og_image_url,
         stats=stats,
-        cache_performance=f"{cache_stats['hits']}/{cache_stats['misses']}",
+        cache_performance=cache_performance(),
         species=species_list,
         characters_list=characters_list,
         characters_query=generate_characters_query_string(characters_list),
@@ -0,0 +1,144 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from app.utils.encode import FORMAT_PREFERENCE, supported_formats
+from app.utils.metrics import metrics
+from app.utils.permalinks import PERMALINK_SIZE
+from app.utils.render_backend import warm_lineups
+from app.utils.render_params import RenderParams
+from app.utils.render_queue import QueueFull
+from render_worker import render_spec
+
+# Seconds between warming passes, 0 turns the warmer off
+CACHE_WARM_INTERVAL = float(os.getenv("CACHE_WARM_INTERVAL", "600"))
+
+# Sizes the index page embeds, its og:image is warmed separately at PERMALINK_SIZE
+CACHE_WARM_SIZES = [
+    int(size) for size in os.getenv("CACHE_WARM_SIZES", "1024").split(",") if size
+]
+
+# How long to wait on one render before moving on to the next
+CACHE_WARM_TIMEOUT = float(os.getenv("CACHE_WARM_TIMEOUT", "60"))
+
+
+def warm_formats() -> list:
+    """png, plus every raster format a browser could negotiate for the page's image."""
+    supported = supported_formats()
+    return ["png"] + [
+        fmt
+        for fmt in FORMAT_PREFERENCE
+        if fmt in supported and fmt not in ("png", "svg")
+    ]
+
+
+class CacheWarmer:
+    """
+    Pre-renders the default lineup and the default lineup plus each preset
+    into the render cache, at startup and then every `interval` seconds, so
+    the first visitors after a deploy or cache flush get cache hits.
+
+    Renders go through the same scheduler and cache keys as requests. They
+    are submitted one at a time and the pass backs off whenever requests are
+    queued, so warming never crowds out real traffic.
+
+    Each worker runs its own thread, started lazily so nothing runs in a
+    pre-fork master, and a lock file next to the cache lets only one of
+    them warm at a time.
+    """
+
+    def __init__(
+        self,
+        render_cache,
+        scheduler,
+        revision,
+        interval=CACHE_WARM_INTERVAL,
+        sizes=CACHE_WARM_SIZES,
+    ):
+        self.render_cache = render_cache
+        self.scheduler = scheduler
+        self.revision = revision  # Callable returning the current content revision
+        self.interval = interval
+        self.sizes = sizes
+
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """Starts this process's warming thread, if it isn't running yet."""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name="cache-warmer", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.warm()
+            except Exception:
+                logging.exception("Cache warming failed")
+            time.sleep(self.interval)
+
+    def warm(self):
+        """One warming pass, skipped if another worker is already running one."""
+        os.makedirs(self.render_cache.cache_dir, exist_ok=True)
+        lock_path = os.path.join(self.render_cache.cache_dir, ".warm.lock")
+        with open(lock_path, "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            start = time.perf_counter()
+            rendered = 0
+            for params, fmt in self.jobs():
+                if self._warm_one(params, fmt):
+                    rendered += 1
+
+            elapsed = time.perf_counter() - start
+            metrics.observe("cache_warm_seconds", elapsed)
+            logging.info(f"Cache warming rendered {rendered} images in {elapsed:.2f}s")
+
+    def jobs(self):
+        """(params, format) of every image to keep warm, as the templates request them."""
+        formats = warm_formats()
+        for characters in warm_lineups():
+            # The index defaults: measuring to the ears, no species scaling
+            for size in self.sizes:
+                for fmt in formats:
+                    yield RenderParams(characters, size, True, False), fmt
+            # og:image, which link previews fetch as png
+            yield RenderParams(characters, PERMALINK_SIZE, True, False), "png"
+
+    def _warm_one(self, params: RenderParams, fmt: str) -> bool:
+        """Renders one image unless it's cached already. Returns whether it rendered."""
+        query = params.query_string()
+        cache_key = params.cache_key(self.revision(), fmt)
+
+        # Requests first, wait for the queue to drain
+        while self.scheduler.queued() > 0:
+            time.sleep(1)
+
+        if self.render_cache.get(cache_key) is not None:
+            return False
+
+        try:
+            img_data = self.scheduler.render(
+                cache_key,
+                render_spec,
+                (query, fmt),
+                timeout=CACHE_WARM_TIMEOUT,
+            )
+        except (QueueFull, FutureTimeoutError):
+            logging.info(f"Skipped warming {query} as {fmt}, renderer is busy")
+            return False
+        self.render_cache.put(cache_key, img_data)
+        metrics.inc("cache_warm_renders_total")
+        return True
@@ -1,11 +1,12 @@
 import re
-import numpy as np
 import logging
 
+import numpy as np
+
 from math import gcd
 from fractions import Fraction
 
-from app.utils.species_lookup import load_species_data
+from app.utils.species_lookup import registry
 from app.utils.character import Character
 
 
@@ -95,6 +96,48 @@ def convert_to_inches(_input: str) -> int:
     raise ValueError(f"Invalid input format: {_input}")
 
 
+def calculate_height_offsets(characters: list, use_species_scaling=False) -> list:
+    """
+    Calculate the real-world heights for many characters at once, based on their anthro heights.
+    All feral heights are evaluated in one vectorized pass over the registry's height table.
+    If use_species_scaling is True, heights are adjusted to the corresponding 'feral' height.
+    """
+    if not characters:
+        return []
+
+    # Look up the precompiled height model row for every species and gender
+    height_table, lookup = registry.height_table()
+    rows = [lookup(char.species, char.gender) for char in characters]
+    anthro_heights = [char.height for char in characters]
+
+    # Decide which height to use based on the use_species_scaling flag
+    if use_species_scaling:
+        final_heights = np.maximum(height_table.feral_heights(rows, anthro_heights), 2)
+    else:
+        final_heights = anthro_heights
+
+    adjusted = []
+    for character, row, final_height in zip(characters, rows, final_heights):
+        model = height_table.models[row]
+
+        # A new Character object with the adjusted height and original character attributes
+        _char = Character(
+            name=character.name,
+            species=character.species,
+            # Original anthro height
+            height=character.height,
+            # Calculated feral height if scaling applied
+            feral_height=float(final_height),
+            gender=character.gender,
+            image=model.image,
+            ears_offset=model.ears_offset,
+        )
+        _char.color = model.color
+        adjusted.append(_char)
+
+    return adjusted
+
+
 def calculate_height_offset(
     character: Character, use_species_scaling=False
 ) -> Character:
@@ -102,46 +145,4 @@ def calculate_height_offset(
     Calculate the real-world height for a given character, based on their anthro height.
     If use_species_scaling is True, the height will be adjusted to the corresponding 'feral' height.
     """
-
-    # Load species data for the given species
-    species_data = load_species_data(character.species)
-
-    # Extract gender-specific data and interpolation points
-    try:
-        gender_data = species_data[character.gender]
-    except KeyError:
-        # If androgynous or missing, use male as default or handle it
-        gender_data = species_data["male"]
-    anthro_height = character.height
-    height_data = gender_data["data"]
-
-    # Gather height and anthro size data for interpolation
-    heights = [point["height"] for point in height_data]
-    anthro_sizes = [point["anthro_size"] for point in height_data]
-
-    # Perform linear regression to model the anthro size to feral height relationship
-    coef = np.polyfit(anthro_sizes, heights, 1)  # Linear regression coefficients
-    feral_height = np.polyval(coef, anthro_height)
-
-    # Decide which height to use based on the use_species_scaling flag
-    final_height = max(feral_height, 2) if use_species_scaling else anthro_height
-
-    # Return a new Character object with the adjusted height and original character attributes
-    _char = Character(
-        name=character.name,
-        species=character.species,
-        height=anthro_height,  # Original anthro height
-        feral_height=final_height,  # Calculated feral height if scaling applied
-        gender=character.gender,
-        image=gender_data["image"],
-        ears_offset=gender_data["ears_offset"],
-    )
-
-    # MESSY inject color here thanks!
-    try:
-        _char.color = gender_data["color"]
-    except:
-        pass
-
-    # Return
-    return _char
+    return calculate_height_offsets([character], use_species_scaling)[0]
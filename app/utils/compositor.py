@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+
+from PIL import Image
+
+from app.utils.sprite_cache import ImageCache
+
+# Upper bound on cached guideline backgrounds per process
+GUIDELINE_CACHE_BYTES = int(os.getenv("GUIDELINE_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+GUIDELINE_COLOR = (128, 128, 128)  # PIL's "grey"
+
+guideline_cache = ImageCache(GUIDELINE_CACHE_BYTES)
+
+
+def _div255(values):
+    """Rounded division by 255, the same integer math PIL uses for blending."""
+    values += 128
+    return ((values >> 8) + values) >> 8
+
+
+class Layer:
+    """
+    A resized (and possibly tinted) sprite, pre-split for blending. Fully
+    opaque pixels are copied straight through and only the antialiased
+    edge pixels are blended, so compositing doesn't touch transparent areas
+    or make full-size temporaries.
+    """
+
+    def __init__(self, image: Image.Image, dominant_color):
+        pixels = np.asarray(image.convert("RGBA"))
+        alpha = pixels[..., 3]
+
+        self.height, self.width = alpha.shape
+        self.dominant_color = dominant_color
+        self.rgb = pixels[..., :3]
+        self.opaque = alpha == 255
+
+        rows, cols = np.nonzero((alpha > 0) & ~self.opaque)
+        self.edge_rows = rows.astype(np.int32)
+        self.edge_cols = cols.astype(np.int32)
+        self.edge_rgb = self.rgb[rows, cols].astype(np.uint16)
+        self.edge_alpha = alpha[rows, cols, None].astype(np.uint16)
+
+        self.nbytes = (
+            pixels.nbytes
+            + self.opaque.nbytes
+            + self.edge_rows.nbytes * 2
+            + self.edge_rgb.nbytes
+            + self.edge_alpha.nbytes
+        )
+
+
+def guideline_layer(width, height, size, render_height, guidelines):
+    """
+    White background with the grey height guidelines, cached by
+    (width, size, render_height), which fully determine it.
+    """
+    key = (width, size, render_height)
+    background = guideline_cache.get(key)
+    if background is None:
+        background = np.full((height, width, 3), 255, dtype=np.uint8)
+        background[[y for y in guidelines if 0 <= y < height]] = GUIDELINE_COLOR
+        background.flags.writeable = False
+        guideline_cache.put(key, background)
+    return background
+
+
+class Canvas:
+    """
+    The render target: one preallocated RGB array that layers, lines and
+    label masks are blended into, turned into an image once at the end.
+    """
+
+    def __init__(self, width, height, size, render_height, guidelines):
+        self.width = width
+        self.height = height
+        self.pixels = guideline_layer(
+            width, height, size, render_height, guidelines
+        ).copy()
+
+    def paste_layer(self, layer: Layer, x, y):
+        region = self.pixels[y : y + layer.height, x : x + layer.width]
+        np.copyto(region, layer.rgb, where=layer.opaque[..., None])
+        if len(layer.edge_rows):
+            dst = region[layer.edge_rows, layer.edge_cols].astype(np.uint16)
+            region[layer.edge_rows, layer.edge_cols] = _div255(
+                dst * (255 - layer.edge_alpha) + layer.edge_rgb * layer.edge_alpha
+            )
+
+    def fill_rect(self, x0, y0, x1, y1, color):
+        """Fills [x0, x1) x [y0, y1), clipped to the canvas."""
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+        if x0 < x1 and y0 < y1:
+            self.pixels[y0:y1, x0:x1] = color[:3]
+
+    def draw_mask(self, mask: np.ndarray, x, y, color):
+        """Blends `color` through an 8-bit coverage mask placed at (x, y), clipped to the canvas."""
+        x0, y0 = max(x, 0), max(y, 0)
+        x1 = min(x + mask.shape[1], self.width)
+        y1 = min(y + mask.shape[0], self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        alpha = mask[y0 - y : y1 - y, x0 - x : x1 - x, None].astype(np.uint16)
+        region = self.pixels[y0:y1, x0:x1]
+        region[...] = _div255(
+            region * (255 - alpha) + np.array(color[:3], dtype=np.uint16) * alpha
+        )
+
+    def to_image(self) -> Image.Image:
+        return Image.fromarray(self.pixels)
@@ -0,0 +1,77 @@
+import io
+import os
+
+from functools import lru_cache
+
+from PIL import Image, features
+
+# zlib effort for PNG output, 0 (fastest) to 9 (smallest)
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "6"))
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", "85"))
+AVIF_QUALITY = int(os.getenv("AVIF_QUALITY", "60"))
+
+# Formats offered to clients that don't ask for one, best first. PNG is always the fallback.
+FORMAT_PREFERENCE = [
+    f.strip()
+    for f in os.getenv("IMAGE_FORMAT_PREFERENCE", "webp").split(",")
+    if f.strip()
+]
+
+# format name -> (mimetype, file extension)
+FORMATS = {
+    "png": ("image/png", "png"),
+    "png8": ("image/png", "png"),
+    "webp": ("image/webp", "webp"),
+    "avif": ("image/avif", "avif"),
+    # Vector markup referencing sprite URLs, see svg.py. Only ever served when asked for explicitly.
+    "svg": ("image/svg+xml", "svg"),
+}
+
+
+@lru_cache(maxsize=None)
+def supported_formats() -> list:
+    """Output formats this Pillow build can actually encode."""
+    return tuple(
+        fmt for fmt in FORMATS if fmt not in ("webp", "avif") or features.check(fmt)
+    )
+
+
+def negotiate_format(accept) -> str:
+    """
+    Picks an output format from an Accept header (a werkzeug MIMEAccept).
+    Only explicit mimetypes count, `*/*` alone still gets PNG.
+    """
+    accepted = {value for value, quality in accept if quality > 0}
+    supported = supported_formats()
+    for fmt in FORMAT_PREFERENCE:
+        if fmt == "svg":
+            continue  # Browsers accept SVG for <img>, but crawlers and og:image consumers don't
+        if fmt in supported and FORMATS[fmt][0] in accepted:
+            return fmt
+    return "png"
+
+
+def mimetype_for(fmt: str) -> str:
+    return FORMATS[fmt][0]
+
+
+def extension_for(fmt: str) -> str:
+    return FORMATS[fmt][1]
+
+
+def encode_image(image: Image.Image, fmt: str = "png") -> bytes:
+    """Encodes a rendered image in one of the supported output formats."""
+    img_io = io.BytesIO()
+    if fmt == "png8":
+        # Palette-quantized PNG, our renders are mostly flat colors and line art
+        image = image.convert("RGB").quantize(
+            colors=256, method=Image.Quantize.FASTOCTREE
+        )
+        image.save(img_io, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    elif fmt == "webp":
+        image.save(img_io, "WEBP", quality=WEBP_QUALITY, method=4)
+    elif fmt == "avif":
+        image.save(img_io, "AVIF", quality=AVIF_QUALITY)
+    else:
+        image.save(img_io, "PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return img_io.getvalue()
@@ -2,13 +2,86 @@ import os
 import logging
 import numpy as np
 
+from functools import lru_cache
+
 
 from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageOps
 
-from app.utils.calculate_heights import calculate_height_offset, inches_to_feet_inches
+from app.utils.calculate_heights import inches_to_feet_inches
+from app.utils.layout import compute_layout
+from app.utils.metrics import metrics, PhaseTimer, COUNT_BUCKETS, PIXEL_BUCKETS
+from app.utils.compositor import Canvas, Layer
+from app.utils.sprite_cache import (
+    load_sprite,
+    mip_level,
+    resolve_art_path,
+    sprite_dominant_color,
+    layer_cache,
+    ImageCache,
+)
 
 font_path = "app/fonts/OpenSans-Regular.ttf"
 
+# Upper bound on pre-rendered label masks per process
+LABEL_CACHE_BYTES = int(os.getenv("LABEL_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+# Longest label line drawn, names come straight from the URL
+MAX_LABEL_LENGTH = int(os.getenv("MAX_LABEL_LENGTH", "64"))
+
+label_cache = ImageCache(LABEL_CACHE_BYTES)
+
+
+@lru_cache(maxsize=128)
+def get_font(font_size):
+    """Parses the font once per size, instead of once per render."""
+    return ImageFont.truetype(font_path, font_size)
+
+
+def clip_label(text):
+    """Cuts every line of a label down to MAX_LABEL_LENGTH characters."""
+    return "\n".join(
+        line if len(line) <= MAX_LABEL_LENGTH else line[: MAX_LABEL_LENGTH - 1] + "…"
+        for line in text.split("\n")
+    )
+
+
+class LabelMask:
+    """An antialiased coverage mask of some text, and its offset from the text origin."""
+
+    def __init__(self, left, top, mask):
+        self.left = left
+        self.top = top
+        self.mask = mask
+        self.nbytes = mask.nbytes
+
+
+def label_mask(text, font_size) -> LabelMask:
+    """
+    Renders (possibly multi-line) text once as an antialiased coverage mask,
+    cached by size in bytes. The mask is read-only. Fill colour is applied
+    when blending, so every colour shares one cached mask.
+    """
+    key = (text, font_size)
+    label = label_cache.get(key)
+    if label is None:
+        font = get_font(font_size)
+        left, top, right, bottom = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox(
+            (0, 0), text, font=font
+        )
+        mask = Image.new("L", (max(right - left, 1), max(bottom - top, 1)), 0)
+        ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+        mask = np.asarray(mask)
+        mask.flags.writeable = False
+        label = LabelMask(left, top, mask)
+        label_cache.put(key, label)
+    return label
+
+
+def draw_label(canvas, xy, text, font_size, fill):
+    """Same result as `ImageDraw.text`, from a cached mask. Overlong lines are clipped."""
+    label = label_mask(clip_label(text), font_size)
+    canvas.draw_mask(label.mask, xy[0] + label.left, xy[1] + label.top, fill)
+
 
 def apply_color_shift(image, color):
     """Applies a color tint using the alpha channel as a mask."""
@@ -18,52 +91,62 @@ def apply_color_shift(image, color):
     # Convert hex color to RGB
     r, g, b = tuple(int(color[i : i + 2], 16) for i in (0, 2, 4))
 
-    # Convert image to RGBA if it's not already
-    image = image.convert("RGBA")
-
-    # Extract alpha channel as a mask
-    alpha = image.getchannel("A")
-
-    # Create a solid color image
-    color_overlay = Image.new("RGBA", image.size, (r, g, b, 255))
+    # Flood the sprite's shape with the tint. Resampled edges are only partly
+    # opaque, compositing over them would keep most of the original outline
+    tinted_image = Image.new("RGBA", image.size, (r, g, b))
+    tinted_image.putalpha(image.convert("RGBA").getchannel("A"))
 
-    # Apply the alpha mask so only visible areas are colored
-    tinted_image = Image.composite(color_overlay, image, alpha)
-
-    print("--------> Tinted image!")
     return tinted_image
 
 
-def extract_dominant_color(image):
-    """Extracts the dominant color of an image by resizing it to 1x1 to get the average color."""
-    small_img = image.resize((1, 1))
-    return small_img.getpixel((0, 0))
+def load_layer(rel_path, color, size):
+    """
+    Returns the sprite resized to `size`, tinted with `color` if set, as a
+    compositor layer. Tinting happens at the target resolution, and the
+    layer is cached by (sprite, color, size) along with its dominant color.
+    """
+    key = (resolve_art_path(rel_path), color, size)
+    layer = layer_cache.get(key)
+    if layer is None:
+        # Resample from the smallest pre-scaled copy that's still big enough
+        sprite = load_sprite(rel_path, mip_level(rel_path, size))
+        resized = sprite.resize(size, Image.LANCZOS)
+        if color:
+            resized = apply_color_shift(resized, color)
+        layer = Layer(resized, label_color(rel_path, color))
+        layer_cache.put(key, layer)
+    return layer
+
+
+def label_color(rel_path, color):
+    """
+    Color for a character's labels and ear line: its tint, otherwise the
+    sprite's average color from the manifest. Never needs the pixels.
+    """
+    if color:
+        return tuple(int(color[i : i + 2], 16) for i in (0, 2, 4))
+    return sprite_dominant_color(rel_path)
 
 
-def draw_dotted_line(draw, x_start, x_end, y, color, scale=1024):
-    """Draws a dotted line on the ImageDraw canvas."""
+def draw_dotted_line(canvas, x_start, x_end, y, color, scale=1024):
+    """Draws a dotted line on the canvas, dash for dash what `ImageDraw.line` drew."""
     x = x_start
 
     dash_length = int((40 * scale) / 1024)
     gap = int((20 * scale) / 1024)
     width = int((8 * scale) / 1024)
+    if width == 0:
+        return
+
+    # A `width` wide horizontal line covers these rows, and both end columns
+    y_top = y - (width - 1) // 2
+    y_bottom = y + width // 2 + 1
 
     while x < x_end:
-        draw.line([(x, y), (min(x + dash_length, x_end), y)], fill=color, width=width)
+        canvas.fill_rect(x, y_top, min(x + dash_length, x_end) + 1, y_bottom, color)
         x += dash_length + gap
 
 
-def get_art_image_path(rel_path):
-    """
-    Returns the path to the trimmed image in art/dist/ if it exists, otherwise falls back to art/.
-    """
-    import os
-
-    dist_path = os.path.join("art", "dist", rel_path)
-    orig_path = os.path.join("art", rel_path)
-    return dist_path if os.path.exists(dist_path) else orig_path
-
-
 def render_image(
     char_list,
     size,
@@ -74,147 +157,92 @@ def render_image(
     Generates an image comparing character heights, with options to measure to the top of the ears.
     """
 
-    # Limit size between 100 and 2048
-    size = max(100, min(size, 2048))
-
-    # Cache miss, so generate the image
-    height_adjusted_chars = []
+    timer = PhaseTimer()
 
-    # Step 1: Calculate scaled heights, adjusting for ears offset if applicable
-    for char in char_list:
-        adjusted_char = calculate_height_offset(
-            char, use_species_scaling=use_species_scaling
-        )
-
-        # Calculate visual height by adding ears_offset percentage if applicable
-        if measure_to_ears and adjusted_char.ears_offset != 0.0:
-            # Increase height by a percentage factor so the top of the character appears taller
-            adjusted_char.visual_height = adjusted_char.feral_height * (
-                1 + adjusted_char.ears_offset / 100.0
-            )
-        else:
-            # Default to actual character height if not measuring to ears
-            adjusted_char.visual_height = adjusted_char.feral_height
-
-        height_adjusted_chars.append(adjusted_char)
-
-    # Step 2: Determine the render height based on the tallest character's visual height
-    tallest_char_visual_height = max(
-        char.visual_height for char in height_adjusted_chars
+    # Steps 1-6: Heights, scale factors and character boxes
+    layout = compute_layout(
+        char_list,
+        size,
+        measure_to_ears=measure_to_ears,
+        use_species_scaling=use_species_scaling,
+        timer=timer,
+    )
+    size = layout.size
+    font_size = layout.font_size
+
+    # Steps 7 & 8: Start from the (cached) white background with guideline lines at actual height
+    canvas = Canvas(
+        layout.width,
+        layout.height,
+        size,
+        layout.render_height,
+        layout.guidelines,
     )
-    render_height = int(tallest_char_visual_height * 1.05)  # Add 5% padding
-
-    # Decide line granularity based on height
-    draw_line_at_foot = render_height > 22
-
-    # Step 3: Calculate scale factors based on render height
-    scale_factors = [
-        char.visual_height / render_height for char in height_adjusted_chars
-    ]
-
-    # Step 4: Set dynamic font size based on image size
-    font_size = int(size / 20)
-    font = ImageFont.truetype(font_path, font_size)
-
-    # Step 5: Padding between characters
-    char_padding = font_size * 6
-
-    # Step 6: Calculate total width and character dimensions, using visual height to determine image scaling
-    total_width = 0
-    character_dimensions = []
-    for i, char in enumerate(height_adjusted_chars):
-        scale_factor = scale_factors[i]
-
-        # Scale character image height based on visual height, including ears offset
-        char_img_height = int(size * scale_factor)
-        char_img = Image.open(get_art_image_path(char.image))
-
-        # Calculate width based on original aspect ratio
-        char_img_width = int(char_img.width * (char_img_height / char_img.height))
-
-        # Append the calculated dimensions
-        character_dimensions.append((char_img_width, char_img_height))
-        total_width += char_img_width + char_padding
-
-    # Step 7: Create the base image with extra space for bottom padding
-    bottom_padding = int(size / 10)
-    image = Image.new("RGB", (total_width, size + bottom_padding), "white")
-    draw = ImageDraw.Draw(image)
-
-    # Step 8: Draw guideline lines at actual height
-    if draw_line_at_foot:
-        for foot in range(0, int(render_height / 12) + 1):
-            y_pos = size - int((foot * 12) / render_height * size)
-            draw.line([(0, y_pos), (total_width, y_pos)], fill="grey", width=1)
-    else:
-        for inch in range(0, int(render_height) + 1):
-            y_pos = size - int((inch) / render_height * size)
-            draw.line([(0, y_pos), (total_width, y_pos)], fill="grey", width=1)
 
     # Step 9: Place each character onto the canvas, scaled by visual height
-    x_offset = 0
-    for i, char in enumerate(height_adjusted_chars):
-        char_img_width, char_img_height = character_dimensions[i]
-        char_img = Image.open(get_art_image_path(char.image))
+    for box in layout.boxes:
+        char = box.char
 
-        # Apply color shift if `char.color` is set
-        print(f"--------> COLOR WAS {char.color}")
-        if char.color:
-            char_img = apply_color_shift(char_img, char.color)
+        # Resized (and tinted, if `char.color` is set) sprite, ready to blend
+        with timer("resize"):
+            layer = load_layer(char.image, char.color, (box.width, box.height))
+        dominant_color = layer.dominant_color
 
-        # Resize the character image based on calculated dimensions
-        char_img = char_img.resize((char_img_width, char_img_height), Image.LANCZOS)
-        dominant_color = extract_dominant_color(char_img)
-
-        if measure_to_ears and char.ears_offset != 0.0:
+        if box.height_line_y is not None:
             # Draw the height line at the actual height (excluding ears offset)
-            y_height_line = size - int((char.feral_height / render_height) * size)
             draw_dotted_line(
-                draw,
-                x_offset,
-                x_offset + char_img_width,
-                y_height_line,
+                canvas,
+                box.x,
+                box.x + box.width,
+                box.height_line_y,
                 color=dominant_color,
                 scale=size,
             )
 
         # Paste character image slightly above the height line to account for ears offset
-        y_offset = size - char_img_height
-        image.paste(char_img, (x_offset, y_offset), char_img.convert("RGBA").split()[3])
+        with timer("composite"):
+            canvas.paste_layer(layer, box.x, box.y)
 
         # Draw character's name and height
-        text_x = x_offset + int(1.1 * char_img_width)
-        text_y = y_offset + int(0.1 * char_img_height)
-        draw.text(
-            (text_x, text_y - (font_size + 5)),
-            char.name,
-            font=font,
-            fill=dominant_color,
-        )
-        height_ft_in = (
-            f"{inches_to_feet_inches(char.feral_height)}\n{char.get_species_name()}"
-            + (
-                f"\n({inches_to_feet_inches(char.height)})"
-                if char.height != char.feral_height
-                else ""
+        with timer("text_draw"):
+            draw_label(
+                canvas,
+                (box.label_x, box.label_y - (font_size + 5)),
+                char.name,
+                font_size,
+                dominant_color,
+            )
+            height_ft_in = (
+                f"{inches_to_feet_inches(char.feral_height)}\n{char.get_species_name()}"
+                + (
+                    f"\n({inches_to_feet_inches(char.height)})"
+                    if char.height != char.feral_height
+                    else ""
+                )
+            )
+            draw_label(
+                canvas,
+                (box.label_x, box.label_y),
+                height_ft_in,
+                font_size,
+                dominant_color,
             )
-        )
-        draw.text(
-            (text_x, text_y),
-            height_ft_in,
-            font=font,
-            fill=dominant_color,
-        )
 
-        x_offset += char_img_width + char_padding
+    image = canvas.to_image()
 
     # This is ONLY to denote the development image
     if os.getenv("DEBUG", False):
-        draw.text(
+        ImageDraw.Draw(image).text(
             (0, size),
             f"DEVELOPMENT VERSION {os.getenv('GIT_COMMIT', '')}  " * 20,
-            font=font,
+            font=get_font(font_size),
             fill=(128, 0, 30),
         )
 
+    timer.observe()
+    metrics.observe("render_characters", len(char_list), buckets=COUNT_BUCKETS)
+    metrics.observe(
+        "render_canvas_pixels", image.width * image.height, buckets=PIXEL_BUCKETS
+    )
+
     return image
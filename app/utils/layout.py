@@ -0,0 +1,166 @@
+from app.utils.calculate_heights import calculate_height_offsets
+from app.utils.metrics import PhaseTimer
+from app.utils.sprite_cache import sprite_size
+
+
+class CharacterBox:
+    """Where one character lands on the canvas, in pixels."""
+
+    def __init__(self, char, scale_factor, x, y, width, height, height_line_y=None):
+        self.char = char
+        self.scale_factor = scale_factor
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+        # Dotted line at the real height when measuring to the ears, else None
+        self.height_line_y = height_line_y
+
+        # Name goes one line above the label, height and species at it
+        self.label_x = x + int(1.1 * width)
+        self.label_y = y + int(0.1 * height)
+
+
+class Layout:
+    """
+    All the geometry of a comparison image, without any pixels. The renderer
+    draws from this, and /api/layout returns it as is.
+    """
+
+    def __init__(self, size, boxes, render_height, font_size, char_padding):
+        self.size = size
+        self.boxes = boxes
+        self.render_height = render_height
+        self.font_size = font_size
+        self.char_padding = char_padding
+        self.bottom_padding = int(size / 10)
+        self.width = sum(box.width + char_padding for box in boxes)
+        self.height = size + self.bottom_padding
+
+        # Decide line granularity based on height, a line per foot or per inch
+        self.guideline_step = 12 if render_height > 22 else 1
+        self.guidelines = [
+            size - int((step * self.guideline_step) / render_height * size)
+            for step in range(0, int(render_height / self.guideline_step) + 1)
+        ]
+
+    @property
+    def characters(self):
+        return [box.char for box in self.boxes]
+
+    def to_dict(self) -> dict:
+        return {
+            "size": self.size,
+            "width": self.width,
+            "height": self.height,
+            "render_height": self.render_height,
+            "font_size": self.font_size,
+            "guideline_step_inches": self.guideline_step,
+            "guidelines": self.guidelines,
+            "characters": [
+                {
+                    "name": box.char.name,
+                    "species": box.char.species,
+                    "gender": box.char.gender,
+                    "height": box.char.height,
+                    "feral_height": box.char.feral_height,
+                    "visual_height": box.char.visual_height,
+                    "ears_offset": box.char.ears_offset,
+                    "scale_factor": box.scale_factor,
+                    "image": box.char.image,
+                    "color": box.char.color,
+                    "box": {
+                        "x": box.x,
+                        "y": box.y,
+                        "width": box.width,
+                        "height": box.height,
+                    },
+                    "height_line_y": box.height_line_y,
+                    "label": {"x": box.label_x, "y": box.label_y},
+                }
+                for box in self.boxes
+            ],
+        }
+
+
+def compute_layout(
+    char_list,
+    size,
+    measure_to_ears: bool = True,
+    use_species_scaling: bool = False,
+    timer=None,
+) -> Layout:
+    """
+    Works out heights, scale factors and pixel boxes for a lineup. Only
+    sprite dimensions are needed, which come from cached image headers.
+    """
+    timer = timer or PhaseTimer()
+
+    # Limit size between 100 and 2048
+    size = max(100, min(size, 2048))
+
+    # Step 1: Calculate scaled heights in one batch, adjusting for ears offset if applicable
+    with timer("height_calc"):
+        height_adjusted_chars = calculate_height_offsets(
+            char_list, use_species_scaling=use_species_scaling
+        )
+        for adjusted_char in height_adjusted_chars:
+            # Calculate visual height by adding ears_offset percentage if applicable
+            if measure_to_ears and adjusted_char.ears_offset != 0.0:
+                # Increase height by a percentage factor so the top of the character appears taller
+                adjusted_char.visual_height = adjusted_char.feral_height * (
+                    1 + adjusted_char.ears_offset / 100.0
+                )
+            else:
+                # Default to actual character height if not measuring to ears
+                adjusted_char.visual_height = adjusted_char.feral_height
+
+    # Step 2: Determine the render height based on the tallest character's visual height
+    tallest_char_visual_height = max(
+        char.visual_height for char in height_adjusted_chars
+    )
+    render_height = int(tallest_char_visual_height * 1.05)  # Add 5% padding
+
+    # Step 3: Calculate scale factors based on render height
+    scale_factors = [
+        char.visual_height / render_height for char in height_adjusted_chars
+    ]
+
+    # Step 4: Set dynamic font size based on image size
+    font_size = int(size / 20)
+
+    # Step 5: Padding between characters
+    char_padding = font_size * 6
+
+    # Step 6: Calculate character boxes, using visual height to determine image scaling
+    boxes = []
+    x_offset = 0
+    for char, scale_factor in zip(height_adjusted_chars, scale_factors):
+        # Scale character image height based on visual height, including ears offset
+        char_img_height = int(size * scale_factor)
+        with timer("sprite_load"):
+            sprite_width, sprite_height = sprite_size(char.image)
+
+        # Calculate width based on original aspect ratio
+        char_img_width = int(sprite_width * (char_img_height / sprite_height))
+
+        height_line_y = None
+        if measure_to_ears and char.ears_offset != 0.0:
+            # The height line sits at the actual height (excluding ears offset)
+            height_line_y = size - int((char.feral_height / render_height) * size)
+
+        boxes.append(
+            CharacterBox(
+                char,
+                scale_factor,
+                x_offset,
+                size - char_img_height,
+                char_img_width,
+                char_img_height,
+                height_line_y,
+            )
+        )
+        x_offset += char_img_width + char_padding
+
+    return Layout(size, boxes, render_height, font_size, char_padding)
@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import logging
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+# Every worker writes its own snapshot here, /metrics merges them
+METRICS_DIR = os.getenv("METRICS_DIR", "/tmp/size-diff/metrics")
+
+# How often each worker writes its snapshot, in seconds
+METRICS_WRITE_INTERVAL = float(os.getenv("METRICS_WRITE_INTERVAL", "5"))
+
+# A snapshot not rewritten for this long belongs to a worker that's gone, even if its pid is reused
+METRICS_STALE_AFTER = float(os.getenv("METRICS_STALE_AFTER", "300"))
+
+# Counters and histograms of exited workers, folded together so totals never go backwards
+RETIRED_FILE = "retired.json"
+
+# Retired instances remembered, so a snapshot that couldn't be deleted isn't folded twice
+RETIRED_HISTORY = 1000
+
+PREFIX = "size_diff_"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 50)
+PIXEL_BUCKETS = (1e5, 2.5e5, 5e5, 1e6, 2e6, 4e6, 8e6, 16e6, 32e6)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_snapshot(directory, name, snapshot):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, os.path.join(directory, name))
+
+
+def _merge(snapshot, counters, histograms):
+    """Adds a snapshot's counters and histograms into the merged dicts."""
+    for name, labels, value in snapshot["counters"]:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+
+    for name, labels, buckets, counts, total, count in snapshot["histograms"]:
+        key = (name, tuple(map(tuple, labels)))
+        merged = histograms.setdefault(key, [buckets, [0] * len(buckets), 0, 0])
+        merged[1] = [a + b for a, b in zip(merged[1], counts)]
+        merged[2] += total
+        merged[3] += count
+
+
+def _format_labels(labels, extra=()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Metrics:
+    """
+    Prometheus-style counters, gauges and histograms aggregated across workers.
+
+    Each process keeps its own values in memory and periodically writes them
+    to `<METRICS_DIR>/<pid>-<instance>.json`, unique per process even when a
+    pid is reused. `render()` merges every snapshot: counters and histograms
+    are summed over all files, gauges only over workers still alive.
+
+    Snapshots of exited workers are folded into `retired.json` and deleted by
+    `retire()`, so totals never go backwards and the directory doesn't grow.
+    """
+
+    def __init__(self, metrics_dir=METRICS_DIR, write_interval=METRICS_WRITE_INTERVAL):
+        self.metrics_dir = metrics_dir
+        self.write_interval = write_interval
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._instance = None
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}  # (name, labels) -> value
+        # (name, labels) -> [buckets, cumulative counts, sum, count]
+        self._histograms = {}
+        self._collectors = []
+        self._writer = None
+        self._stopping = threading.Event()
+
+        # A fork can land while another thread holds the lock, the child needs its own
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # The writer thread isn't copied into the child, but a lock it held at fork time would be
+        self._lock = threading.Lock()
+
+    def _ensure_process(self):
+        """Forked workers start with empty metrics and their own writer thread."""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._instance = uuid.uuid4().hex[:12]
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+            self._stopping = threading.Event()
+            self._writer = threading.Thread(
+                target=self._write_loop,
+                args=(self._stopping,),
+                name="metrics-write",
+                daemon=True,
+            )
+            self._writer.start()
+
+    def stop(self):
+        """
+        Stops this process's writer thread and waits for it, e.g. in a
+        pre-fork master so no thread can hold a cache lock when workers are
+        forked. Recording anything afterwards starts over from empty.
+        """
+        with self._lock:
+            writer = self._writer if self._pid == os.getpid() else None
+            self._pid = None
+            self._writer = None
+            self._stopping.set()
+        if writer is not None:
+            writer.join()
+
+    def _write_loop(self, stopping):
+        while not stopping.wait(self.write_interval):
+            try:
+                self.write()
+            except Exception as e:
+                logging.warning(f"Could not write metrics snapshot: {e}")
+
+    def register_collector(self, collector):
+        """Registers a callable run before every snapshot, for values kept elsewhere."""
+        self._collectors.append(collector)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._ensure_process()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_counter(self, name: str, value: float, **labels):
+        """Sets a counter to an absolute value tracked by someone else."""
+        self._ensure_process()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        self._ensure_process()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def inc_gauge(self, name: str, value: float = 1, **labels):
+        self._ensure_process()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS, **labels):
+        self._ensure_process()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [list(buckets), [0] * len(buckets), 0.0, 0]
+                self._histograms[key] = histogram
+            for i, le in enumerate(histogram[0]):
+                if value <= le:
+                    histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        self._ensure_process()
+        for collector in self._collectors:
+            collector(self)
+        with self._lock:
+            return {
+                "pid": self._pid,
+                "instance": self._instance,
+                "counters": [[n, l, v] for (n, l), v in self._counters.items()],
+                "gauges": [[n, l, v] for (n, l), v in self._gauges.items()],
+                "histograms": [
+                    [n, l, list(h[0]), list(h[1]), h[2], h[3]]
+                    for (n, l), h in self._histograms.items()
+                ],
+            }
+
+    def write(self):
+        """Atomically writes this process's snapshot for other workers to read."""
+        snapshot = self.snapshot()
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        _write_snapshot(
+            self.metrics_dir,
+            f"{snapshot['pid']}-{snapshot['instance']}.json",
+            snapshot,
+        )
+
+    def retire(self, pid=None):
+        """
+        Folds the counters and histograms of workers that are gone into the
+        retired totals and deletes their snapshots. A worker is gone when its
+        pid is dead, is `pid` (gunicorn's child_exit knows exactly which), or
+        it stopped writing for METRICS_STALE_AFTER seconds.
+        """
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        with open(os.path.join(self.metrics_dir, ".retire.lock"), "w") as lock_file:
+            # Only one process may rewrite the retired totals at a time
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            now = time.time()
+            gone = []
+            for entry in os.scandir(self.metrics_dir):
+                if not entry.name.endswith(".json") or entry.name == RETIRED_FILE:
+                    continue
+                snapshot = _read_snapshot(entry.path)
+                if snapshot is None:
+                    continue
+                try:
+                    stale = now - entry.stat().st_mtime > METRICS_STALE_AFTER
+                except FileNotFoundError:
+                    continue
+                if snapshot["pid"] == pid or stale or not _pid_alive(snapshot["pid"]):
+                    gone.append((entry.path, snapshot))
+            if not gone:
+                return
+
+            retired_path = os.path.join(self.metrics_dir, RETIRED_FILE)
+            retired = _read_snapshot(retired_path) or {
+                "counters": [],
+                "histograms": [],
+                "instances": [],
+            }
+            counters, histograms = {}, {}
+            _merge(retired, counters, histograms)
+            instances = retired["instances"]
+            for path, snapshot in gone:
+                instance = snapshot.get("instance", os.path.basename(path))
+                if instance not in instances:
+                    _merge(snapshot, counters, histograms)
+                    instances.append(instance)
+
+            _write_snapshot(
+                self.metrics_dir,
+                RETIRED_FILE,
+                {
+                    "counters": [[n, l, v] for (n, l), v in counters.items()],
+                    "histograms": [
+                        [n, l, h[0], h[1], h[2], h[3]]
+                        for (n, l), h in histograms.items()
+                    ],
+                    "instances": instances[-RETIRED_HISTORY:],
+                },
+            )
+            for path, _ in gone:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def aggregate(self, fresh: bool = True) -> dict:
+        """
+        Merges the snapshots of every worker. With `fresh`, this worker's
+        snapshot is rewritten first instead of being up to one interval old.
+        """
+        if fresh:
+            self.write()
+        else:
+            os.makedirs(self.metrics_dir, exist_ok=True)
+        self.retire()
+
+        counters, gauges, histograms = {}, {}, {}
+        with open(os.path.join(self.metrics_dir, ".retire.lock"), "w") as lock_file:
+            # Don't read halfway through another worker folding snapshots into the retired totals
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            for entry in os.scandir(self.metrics_dir):
+                if not entry.name.endswith(".json"):
+                    continue
+                snapshot = _read_snapshot(entry.path)
+                if snapshot is None:
+                    continue
+
+                _merge(snapshot, counters, histograms)
+
+                # Retired totals have no gauges, and every other snapshot is a live worker
+                for name, labels, value in snapshot.get("gauges", []):
+                    key = (name, tuple(map(tuple, labels)))
+                    gauges[key] = gauges.get(key, 0) + value
+
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def render(self) -> str:
+        """Prometheus text exposition of the aggregated metrics."""
+        aggregated = self.aggregate()
+        lines = []
+
+        def _typed(kind, items):
+            seen = set()
+            for (name, labels), value in sorted(items.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                yield name, labels, value
+
+        for name, labels, value in _typed("counter", aggregated["counters"]):
+            lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+        for name, labels, value in _typed("gauge", aggregated["gauges"]):
+            lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+        for name, labels, histogram in _typed("histogram", aggregated["histograms"]):
+            buckets, counts, total, count = histogram
+            for le, bucket_count in zip(buckets, counts):
+                lines.append(
+                    f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', le)])} {bucket_count}"
+                )
+            lines.append(
+                f"{PREFIX}{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}"
+            )
+            lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+class PhaseTimer:
+    """
+    Accumulates time spent in each phase of one render, then records every
+    phase once as `render_phase_seconds{phase=...}`.
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def __call__(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] = (
+                self.phases.get(phase, 0.0) + time.perf_counter() - start
+            )
+
+    def observe(self):
+        for phase, seconds in self.phases.items():
+            metrics.observe("render_phase_seconds", seconds, phase=phase)
+
+
+metrics = Metrics()
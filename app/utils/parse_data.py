@@ -1,8 +1,13 @@
+import os
 import logging
 from app.utils.character import Character
 from app.utils.species_lookup import load_species_data
 from app.utils.calculate_heights import calculate_height_offset
 
+PRESETS_PATH = "app/species_data/preset_species.yaml"
+
+_presets = (None, [])  # (mtime, presets)
+
 
 def extract_characters(query_string: str) -> list:
     """
@@ -82,13 +87,20 @@ def load_preset_characters():
     """
     Loads preset characters from the preset_species.yaml file.
     Returns a list of dicts with keys: name, species, gender, height, description.
+    The file is only parsed again when it changes.
     """
+    global _presets
+
     import yaml
 
     try:
-        with open("app/species_data/preset_species.yaml", "r") as f:
-            data = yaml.safe_load(f)
-        return data.get("presets", [])
+        mtime = os.stat(PRESETS_PATH).st_mtime
+        if _presets[0] != mtime:
+            with open(PRESETS_PATH, "r") as f:
+                data = yaml.safe_load(f)
+            _presets = (mtime, data.get("presets", []))
+        # Copies, callers are free to modify what they get
+        return [dict(preset) for preset in _presets[1]]
     except Exception as e:
         logging.warning(f"Could not load preset characters: {e}")
         return []
@@ -0,0 +1,241 @@
+import os
+import hashlib
+import sqlite3
+import logging
+import tempfile
+import threading
+
+from datetime import datetime
+
+# Default permalink location, shared by every worker on the box
+if os.getenv("GIT_COMMIT"):
+    DEFAULT_PERMALINK_DIR = "/var/size-diff/permalinks"
+else:
+    # Else we're running default/debug mode
+    DEFAULT_PERMALINK_DIR = "/tmp/size-diff/permalinks"
+
+PERMALINK_DIR = os.getenv("PERMALINK_DIR", DEFAULT_PERMALINK_DIR)
+
+# Size of the stored image, the og:image size embeds show
+PERMALINK_SIZE = int(os.getenv("PERMALINK_SIZE", "630"))
+
+# Shortest ID handed out, grown by a character on the (unlikely) hash collision
+PERMALINK_ID_LENGTH = 8
+
+# Most links kept, past it the least recently used ones are deleted
+PERMALINK_MAX_LINKS = int(os.getenv("PERMALINK_MAX_LINKS", "100000"))
+
+# Upper bound on stored images, past it the least recently used ones are deleted (and re-rendered on demand)
+PERMALINK_MAX_IMAGE_BYTES = int(
+    os.getenv("PERMALINK_MAX_IMAGE_BYTES", str(256 * 1024 * 1024))
+)
+
+# Trim stored images down to this fraction of the budget once it's exceeded
+LOW_WATER = 0.9
+
+BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+
+def _base62(number: int) -> str:
+    digits = []
+    while number:
+        number, digit = divmod(number, 62)
+        digits.append(BASE62[digit])
+    return "".join(reversed(digits)) or "0"
+
+
+class PermalinkStore:
+    """
+    Short, permanent IDs for lineups, kept in a sqlite table next to the
+    image rendered for each one.
+
+    IDs are derived from a hash of the canonical lineup, so the same
+    lineup always gets the same link. Images are keyed by the content
+    revision they were rendered at, so each is rendered once per art or
+    species data change and then served as a plain file.
+
+    Links and images are both bounded, evicting the least recently used.
+    """
+
+    def __init__(
+        self,
+        permalink_dir=PERMALINK_DIR,
+        max_links=PERMALINK_MAX_LINKS,
+        max_image_bytes=PERMALINK_MAX_IMAGE_BYTES,
+    ):
+        self.permalink_dir = permalink_dir
+        self.db_path = os.path.join(permalink_dir, "permalinks.db")
+        self.image_dir = os.path.join(permalink_dir, "images")
+        self.max_links = max_links
+        self.max_image_bytes = max_image_bytes
+
+        self._lock = threading.Lock()  # Serializes use of the shared connection
+        self._pid = None
+        self._conn = None
+
+        self._initialize_db()
+
+    def _initialize_db(self):
+        os.makedirs(self.image_dir, exist_ok=True)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS permalinks (
+                    id TEXT PRIMARY KEY,
+                    query TEXT NOT NULL UNIQUE,
+                    created TEXT NOT NULL,
+                    last_used TEXT NOT NULL,
+                    image_revision TEXT,
+                    image_bytes INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS permalinks_last_used ON permalinks (last_used)"
+            )
+
+    def _connection(self):
+        # Connections don't survive a fork, every worker opens its own
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self.db_path, timeout=10, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    def create(self, query: str) -> str:
+        """Returns the permalink ID of a canonical lineup query, storing it if it's new."""
+        digest = int(hashlib.sha256(query.encode("utf-8")).hexdigest(), 16)
+        full_id = _base62(digest)
+        now = datetime.now().isoformat(timespec="seconds")
+
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT id FROM permalinks WHERE query = ?", (query,)
+            ).fetchone()
+            if row:
+                return row[0]
+
+            # Grow the ID past any prefix that's already taken by another lineup
+            for length in range(PERMALINK_ID_LENGTH, len(full_id) + 1):
+                link_id = full_id[:length]
+                with conn:
+                    cursor = conn.execute(
+                        "INSERT OR IGNORE INTO permalinks (id, query, created, last_used) VALUES (?, ?, ?, ?)",
+                        (link_id, query, now, now),
+                    )
+                if cursor.rowcount:
+                    self._evict_links(conn)
+                    return link_id
+
+                row = conn.execute(
+                    "SELECT id FROM permalinks WHERE query = ?", (query,)
+                ).fetchone()
+                if row:
+                    return row[0]  # Another worker stored it first
+
+        raise RuntimeError(f"No free permalink ID for {query}")
+
+    def get(self, link_id: str):
+        """Returns the lineup query stored for an ID, or None. Marks the link as used."""
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT query, last_used FROM permalinks WHERE id = ?", (link_id,)
+            ).fetchone()
+            if row and row[1] < today:
+                # Recency only needs to be as fine as a day, so most reads don't write
+                with conn:
+                    conn.execute(
+                        "UPDATE permalinks SET last_used = ? WHERE id = ?",
+                        (datetime.now().isoformat(timespec="seconds"), link_id),
+                    )
+        return row[0] if row else None
+
+    def image_path(self, link_id: str, revision: str) -> str:
+        """Where the image of a link rendered at a content revision is stored."""
+        digest = hashlib.sha256(revision.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.image_dir, f"{link_id}-{digest}.png")
+
+    def save_image(self, link_id: str, revision: str, data: bytes):
+        """Atomically stores the rendered image of a permalink, replacing older revisions."""
+        image_path = self.image_path(link_id, revision)
+        fd, tmp_path = tempfile.mkstemp(dir=self.image_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, image_path)
+        except OSError as e:
+            logging.warning(f"Could not store permalink image {link_id}: {e}")
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT image_revision FROM permalinks WHERE id = ?", (link_id,)
+            ).fetchone()
+            if row and row[0] and row[0] != revision:
+                self._remove_image(link_id, row[0])
+            with conn:
+                conn.execute(
+                    "UPDATE permalinks SET image_revision = ?, image_bytes = ? WHERE id = ?",
+                    (revision, len(data), link_id),
+                )
+            self._evict_images(conn)
+
+    def _remove_image(self, link_id, revision):
+        try:
+            os.unlink(self.image_path(link_id, revision))
+        except FileNotFoundError:
+            pass
+
+    def _evict_links(self, conn):
+        """Deletes the least recently used links (and their images) past `max_links`."""
+        excess = conn.execute("SELECT COUNT(*) FROM permalinks").fetchone()[0]
+        excess -= self.max_links
+        if excess <= 0:
+            return
+        evicted = conn.execute(
+            "SELECT id, image_revision FROM permalinks ORDER BY last_used LIMIT ?",
+            (excess,),
+        ).fetchall()
+        with conn:
+            conn.executemany(
+                "DELETE FROM permalinks WHERE id = ?", [(id,) for id, _ in evicted]
+            )
+        for link_id, revision in evicted:
+            if revision:
+                self._remove_image(link_id, revision)
+        logging.info(f"Evicted {len(evicted)} least recently used permalinks")
+
+    def _evict_images(self, conn):
+        """Deletes the least recently used images once they add up to more than `max_image_bytes`."""
+        total = conn.execute("SELECT SUM(image_bytes) FROM permalinks").fetchone()[0]
+        if not total or total <= self.max_image_bytes:
+            return
+
+        target = self.max_image_bytes * LOW_WATER
+        evicted = []
+        for link_id, revision, nbytes in conn.execute(
+            "SELECT id, image_revision, image_bytes FROM permalinks "
+            "WHERE image_bytes > 0 ORDER BY last_used"
+        ):
+            if total <= target:
+                break
+            evicted.append((link_id, revision))
+            total -= nbytes
+
+        with conn:
+            conn.executemany(
+                "UPDATE permalinks SET image_revision = NULL, image_bytes = 0 WHERE id = ?",
+                [(link_id,) for link_id, _ in evicted],
+            )
+        for link_id, revision in evicted:
+            self._remove_image(link_id, revision)
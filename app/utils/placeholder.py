@@ -0,0 +1,65 @@
+import io
+import bisect
+import threading
+
+from functools import lru_cache
+
+import numpy as np
+
+from PIL import Image
+
+# Noise is pre-generated once per bucket and cropped down to the requested size
+SIZE_BUCKETS = [128, 256, 512, 1024, 2048]
+
+_noise_lock = threading.Lock()
+_noise_images = {}  # bucket -> noise image of (bucket * 1.4, bucket)
+
+
+def _noise_image(bucket: int) -> Image.Image:
+    with _noise_lock:
+        noise = _noise_images.get(bucket)
+        if noise is None:
+            # One batched draw for the whole image instead of three randint calls per pixel
+            rng = np.random.default_rng()
+            pixels = rng.integers(
+                0, 256, size=(bucket, int(bucket * 1.4), 3), dtype=np.uint8
+            )
+            noise = Image.fromarray(pixels, "RGB")
+            _noise_images[bucket] = noise
+        return noise
+
+
+def _clamp_size(size: int) -> int:
+    return max(100, min(size, 2048))
+
+
+def placeholder_size(size: int) -> int:
+    """
+    The size an empty lineup is drawn at: its noise bucket, so there are only
+    a handful of placeholders to encode and cache.
+    """
+    return SIZE_BUCKETS[bisect.bisect_left(SIZE_BUCKETS, _clamp_size(size))]
+
+
+def placeholder_image(size: int) -> Image.Image:
+    """
+    Returns a (size * 1.4, size) image of random noise, used when there is nothing to render.
+    Size is clamped to the same 100-2048 range as `render_image`.
+    """
+    size = _clamp_size(size)
+    return _noise_image(placeholder_size(size)).crop((0, 0, int(size * 1.4), size))
+
+
+@lru_cache(maxsize=len(SIZE_BUCKETS))
+def _encode_placeholder(bucket: int) -> bytes:
+    img_io = io.BytesIO()
+    placeholder_image(bucket).save(img_io, "PNG")
+    return img_io.getvalue()
+
+
+def placeholder_png(size: int) -> bytes:
+    """
+    Returns the encoded placeholder PNG for a size, snapped to its bucket.
+    Each bucket is encoded once per process and the bytes are reused.
+    """
+    return _encode_placeholder(placeholder_size(size))
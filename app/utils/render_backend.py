@@ -0,0 +1,128 @@
+import os
+import time
+import logging
+
+from urllib.parse import parse_qsl
+
+from app.utils.character import Character
+from app.utils.encode import encode_image
+from app.utils.generate_image import get_font, render_image
+from app.utils.layout import compute_layout
+from app.utils.metrics import metrics
+from app.utils.parse_data import get_default_characters, load_preset_characters
+from app.utils.placeholder import placeholder_image, placeholder_png
+from app.utils.render_params import RenderParams
+from app.utils.species_lookup import registry
+from app.utils.sprite_cache import load_sprite, mip_level, sprite_manifest
+from app.utils.svg import render_svg, placeholder_svg
+
+# Output sizes warmed before serving: the page's image, og:image and the API default
+WARM_SIZES = [
+    int(size) for size in os.getenv("WARM_SIZES", "1024,630,400").split(",") if size
+]
+
+
+def render_bytes(
+    params: RenderParams, image_format: str, sprite_url_prefix=None
+) -> bytes:
+    """
+    Renders and encodes one image, the whole job a render worker does.
+    `sprite_url_prefix` is where SVG output links its sprites.
+    """
+    with metrics.timer("render_seconds"):
+        if len(params.characters) == 0:
+            logging.warn("Asked to generate an empty image!")
+
+            # Serve the pre-generated (noise) image
+            if image_format == "svg":
+                return placeholder_svg(params.size).encode("utf-8")
+            if image_format == "png":
+                return placeholder_png(params.size)
+            return encode_image(placeholder_image(params.size), image_format)
+
+        if image_format == "svg":
+            return render_svg(
+                params.characters,
+                params.size,
+                measure_to_ears=params.measure_ears,
+                use_species_scaling=params.scale_height,
+                sprite_url_prefix=sprite_url_prefix,
+            ).encode("utf-8")
+
+        image = render_image(
+            params.characters,
+            params.size,
+            measure_to_ears=params.measure_ears,
+            use_species_scaling=params.scale_height,
+        )
+        with metrics.timer("render_phase_seconds", phase="encode"):
+            return encode_image(image, image_format)
+
+
+def render_spec(spec) -> bytes:
+    """
+    Renders from a compact, picklable spec: (canonical query string, format),
+    plus the sprite URL prefix for svg. This is what gets shipped to
+    process-pool workers, through render_worker.
+    """
+    query_string, image_format, *sprite_url_prefix = spec
+    params = RenderParams.from_args(
+        dict(parse_qsl(query_string, keep_blank_values=True))
+    )
+    return render_bytes(params, image_format, *sprite_url_prefix)
+
+
+def warm_lineups() -> list:
+    """The default lineup, and the default lineup plus each preset, as users first see them."""
+    defaults = get_default_characters()
+    lineups = [defaults]
+    for preset in load_preset_characters():
+        lineups.append(
+            defaults
+            + [
+                Character(
+                    name=preset["name"],
+                    species=preset["species"],
+                    height=float(preset["height"]),
+                    gender=preset["gender"],
+                )
+            ]
+        )
+    return lineups
+
+
+def warm_caches(sizes=WARM_SIZES):
+    """
+    Fills this process's caches before it serves anything: species data and
+    height table, presets, the sprite manifest, fonts, and the default scene
+    rendered at each of `sizes` (layers, labels and guidelines included).
+    Preset sprites are decoded at the mip levels their lineups would use.
+
+    Run before forking, workers share all of it copy-on-write.
+    """
+    start = time.perf_counter()
+
+    registry.refresh(force=True)
+    registry.height_table()
+    sprite_manifest()
+
+    lineups = warm_lineups()
+    for size in sizes:
+        get_font(int(size / 20))
+        render_image(lineups[0], size)
+
+        for lineup in lineups[1:]:
+            for box in compute_layout(lineup, size).boxes:
+                try:
+                    load_sprite(
+                        box.char.image,
+                        mip_level(box.char.image, (box.width, box.height)),
+                    )
+                except FileNotFoundError:
+                    logging.warning(
+                        f"Missing art {box.char.image} for {box.char.species}"
+                    )
+
+    logging.info(
+        f"Warmed caches for sizes {list(sizes)} in {time.perf_counter() - start:.2f}s"
+    )
@@ -0,0 +1,175 @@
+import os
+import fcntl
+import hashlib
+import logging
+import tempfile
+import threading
+
+# Default cache location, shared by every worker on the box
+if os.getenv("GIT_COMMIT"):
+    DEFAULT_CACHE_DIR = "/var/size-diff/render-cache"
+else:
+    # Else we're running default/debug mode
+    DEFAULT_CACHE_DIR = "/tmp/size-diff/render-cache"
+
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", DEFAULT_CACHE_DIR)
+RENDER_CACHE_BYTES = int(os.getenv("RENDER_CACHE_BYTES", str(512 * 1024 * 1024)))
+
+# Sweep for evictions after writing this fraction of the budget, and trim down to LOW_WATER
+SWEEP_FRACTION = 0.05
+LOW_WATER = 0.9
+
+
+def make_cache_key(*parts) -> str:
+    """Content address for a render, hashed from its (canonical) parameters."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """
+    Disk-backed, content-addressed cache of encoded images shared by all workers.
+
+    Entries are plain files named by their key, written atomically with a
+    rename so readers never see a partial image. A hit bumps the file's mtime,
+    and eviction removes the least recently used files once the directory
+    grows past `max_bytes`.
+    """
+
+    def __init__(self, cache_dir=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0  # Failed reads and writes, the cache is skipped for those
+
+        self._lock = threading.Lock()
+        self._written_since_sweep = 0
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError as e:
+            logging.warning(f"Render cache directory {cache_dir} is unusable: {e}")
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key: str):
+        """Returns the cached bytes for a key, or None. Unreadable entries count as misses."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            if not data:
+                # Truncated entry, drop it so the next render replaces it
+                os.unlink(path)
+                raise FileNotFoundError(path)
+            # Bump recency for LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        except OSError as e:
+            logging.warning(f"Could not read render cache entry {key}: {e}")
+            with self._lock:
+                self.misses += 1
+                self.errors += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        """
+        Atomically stores bytes under a key. The cache is best-effort, a failed
+        write (full disk, permissions, ...) is logged and the caller carries on.
+        """
+        path = self._path(key)
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Could not write render cache entry {key}: {e}")
+            with self._lock:
+                self.errors += 1
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+            return
+
+        with self._lock:
+            self._written_since_sweep += len(data)
+            should_sweep = self._written_since_sweep > self.max_bytes * SWEEP_FRACTION
+            if should_sweep:
+                self._written_since_sweep = 0
+
+        if should_sweep:
+            try:
+                self.sweep()
+            except OSError as e:
+                logging.warning(f"Render cache sweep failed: {e}")
+                with self._lock:
+                    self.errors += 1
+
+    def _entries(self):
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def sweep(self):
+        """Evict least recently used entries until the cache is back under budget."""
+        lock_path = os.path.join(self.cache_dir, ".sweep.lock")
+        with open(lock_path, "w") as lock_file:
+            try:
+                # Only one worker needs to sweep at a time
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            entries = list(self._entries())
+            total = sum(size for _, size, _ in entries)
+            if total <= self.max_bytes:
+                return
+
+            target = self.max_bytes * LOW_WATER
+            evicted = 0
+            for path, size, _ in sorted(entries, key=lambda e: e[2]):
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+
+            with self._lock:
+                self.evictions += evicted
+            logging.info(f"Render cache evicted {evicted} entries, now {total} bytes")
+
+    def clear(self):
+        for path, _, _ in list(self._entries()):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,112 @@
+from urllib.parse import urlencode
+
+from app.utils.character import Character
+from app.utils.encode import supported_formats
+from app.utils.parse_data import extract_characters
+from app.utils.placeholder import placeholder_size
+from app.utils.render_cache import make_cache_key
+
+DEFAULT_SIZE = 400
+MIN_SIZE = 100
+MAX_SIZE = 2048
+
+
+def format_height(height: float) -> str:
+    """Shortest string that parses back to the same height, so 62 and 62.0 agree."""
+    height = float(height)
+    return str(int(height)) if height.is_integer() else repr(height)
+
+
+class RenderParams:
+    """
+    The exact parameters that reach `render_image`, in canonical form.
+
+    Two requests that would render the same image produce the same
+    `query_string()` and therefore the same cache key.
+    """
+
+    def __init__(
+        self,
+        characters: list,
+        size: int = DEFAULT_SIZE,
+        measure_ears: bool = False,
+        scale_height: bool = False,
+        format=None,
+    ):
+        self.characters = characters
+        self.size = max(MIN_SIZE, min(int(size), MAX_SIZE))
+        if not characters:
+            # Nothing to draw, only the few placeholder sizes exist
+            self.size = placeholder_size(self.size)
+        self.measure_ears = measure_ears
+        self.scale_height = scale_height
+
+        # Explicitly requested output format, None means negotiate from the Accept header
+        self.format = format if format in supported_formats() else None
+
+    @classmethod
+    def from_args(cls, args) -> "RenderParams":
+        """Parses /generate-image request args the same way the renderer always has."""
+        try:
+            size = int(args.get("size", DEFAULT_SIZE))
+        except ValueError:
+            size = DEFAULT_SIZE
+
+        return cls(
+            characters=extract_characters(args.get("characters", "")),
+            size=size,
+            measure_ears=args.get("measure_ears") == "True",
+            scale_height=args.get("scale_height") == "True",
+            format=args.get("format"),
+        )
+
+    @classmethod
+    def from_json(cls, spec: dict) -> "RenderParams":
+        """
+        Builds params from a JSON render spec, as used by the batch API.
+        `characters` is either a query-style string or a list of
+        {species, gender, height, name} objects.
+        """
+        characters = spec.get("characters", "")
+        if isinstance(characters, str):
+            characters = extract_characters(characters)
+        else:
+            characters = [
+                Character(
+                    name=str(c.get("name", "unknown")),
+                    species=str(c.get("species", "unknown")),
+                    height=float(c.get("height", 60)),
+                    gender=str(c.get("gender", "unknown")),
+                )
+                for c in characters
+            ]
+
+        return cls(
+            characters=characters,
+            size=int(spec.get("size", DEFAULT_SIZE)),
+            measure_ears=spec.get("measure_ears") in (True, "True"),
+            scale_height=spec.get("scale_height") in (True, "True"),
+            format=spec.get("format"),
+        )
+
+    def characters_query(self) -> str:
+        return "+".join(
+            f"{c.species},{c.gender},{format_height(c.height)},{c.name}"
+            for c in self.characters
+        )
+
+    def query_string(self, size=None) -> str:
+        """Canonical query string, optionally for a different image size."""
+        size = self.size if size is None else max(MIN_SIZE, min(size, MAX_SIZE))
+        args = [
+            ("characters", self.characters_query()),
+            ("measure_ears", str(self.measure_ears)),
+            ("scale_height", str(self.scale_height)),
+            ("size", str(size)),
+        ]
+        if self.format:
+            args.append(("format", self.format))
+        return urlencode(args, safe=",()")
+
+    def cache_key(self, *extra) -> str:
+        return make_cache_key("render", self.query_string(), *extra)
@@ -0,0 +1,196 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from app.utils.metrics import metrics
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "4"))
+
+# Renders allowed to wait for a worker before new ones are turned away
+RENDER_QUEUE_LIMIT = int(os.getenv("RENDER_QUEUE_LIMIT", "32"))
+
+# "thread" renders inside the web worker, "process" in a pool of render processes
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", "thread")
+
+# Start method for render processes, spawn doesn't inherit the web worker's threads and locks
+RENDER_PROCESS_START_METHOD = os.getenv("RENDER_PROCESS_START_METHOD", "spawn")
+
+
+class QueueFull(Exception):
+    """Raised when the render queue is at its limit."""
+
+
+class Flight:
+    """One in-flight render, shared by every request waiting for the same key."""
+
+    def __init__(self, key, fn, args):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.future = None
+        self.executor = None
+        self.waiters = 1
+        self.retried = False
+
+
+class RenderScheduler:
+    """
+    Runs renders on a worker pool behind a bounded queue.
+
+    - Submissions past `max_queue` queued renders raise `QueueFull` right away.
+    - Concurrent submissions with the same key join the render already in
+      flight (single-flight) instead of rendering again.
+    - When every waiter of a queued render gives up, the render is cancelled
+      before it ever reaches a worker.
+
+    The pool is either threads in this process or render processes that keep
+    their own sprite, font and species caches warm between jobs. With the
+    process backend `fn` and its arguments must be picklable, and
+    `initializer` runs once in every render process. The pool is
+    created lazily per process, so a scheduler built before a fork is safe.
+    If a render process dies (OOM kill, crash in a C extension) the pool is
+    replaced and every render it took down is retried once.
+    """
+
+    def __init__(
+        self,
+        max_workers=RENDER_WORKERS,
+        max_queue=RENDER_QUEUE_LIMIT,
+        backend=RENDER_BACKEND,
+        initializer=None,
+    ):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.backend = backend
+        self.initializer = initializer
+
+        # Reentrant, cancelling a future runs its done callback on this thread
+        self._lock = threading.RLock()
+        self._executor = None
+        self._executor_pid = None
+        self._flights = {}  # key -> Flight
+
+    def _get_executor(self):
+        if self._executor_pid != os.getpid():
+            if self.backend == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context(RENDER_PROCESS_START_METHOD),
+                    initializer=self.initializer,
+                )
+            else:
+                # Threads share this process's caches, there's nothing to warm per worker
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._executor_pid = os.getpid()
+            logging.info(
+                f"Started {self.backend} render pool with {self.max_workers} workers"
+            )
+        return self._executor
+
+    def _replace_executor(self, broken):
+        """Throws away a broken process pool, the next submission starts a new one."""
+        if self._executor is broken and self._executor_pid == os.getpid():
+            logging.warning("Render pool is broken, starting a new one")
+            metrics.inc("render_pool_restarts_total")
+            broken.shutdown(wait=False)
+            self._executor = None
+            self._executor_pid = None
+
+    def _start(self, flight):
+        """Hands a flight to the pool, replacing the pool once if it's broken."""
+        executor = self._get_executor()
+        try:
+            future = executor.submit(flight.fn, *flight.args)
+        except BrokenProcessPool:
+            self._replace_executor(executor)
+            executor = self._get_executor()
+            future = executor.submit(flight.fn, *flight.args)
+        flight.future = future
+        flight.executor = executor
+        future.add_done_callback(lambda _: self._land(flight, future))
+
+    def queued(self) -> int:
+        """Renders submitted but still waiting for a free worker."""
+        return max(0, len(self._flights) - self.max_workers)
+
+    def _update_gauges(self):
+        metrics.set_gauge("render_queue_depth", self.queued())
+        metrics.set_gauge(
+            "renders_in_progress", min(len(self._flights), self.max_workers)
+        )
+
+    def submit(self, key, fn, *args) -> Flight:
+        """Queue `fn(*args)` under `key`, or join the flight already rendering it."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                metrics.inc("render_coalesced_total")
+                return flight
+
+            if self.queued() >= self.max_queue:
+                metrics.inc("render_rejected_total")
+                raise QueueFull()
+
+            flight = Flight(key, fn, args)
+            self._flights[key] = flight
+            self._start(flight)
+            self._update_gauges()
+            return flight
+
+    def _land(self, flight, future):
+        with self._lock:
+            # A retried flight is still in the air, only its latest future lands it
+            if self._flights.get(flight.key) is flight and flight.future is future:
+                del self._flights[flight.key]
+            self._update_gauges()
+
+    def _retry(self, flight, failed):
+        """Re-runs a flight whose render process died, once, on a new pool."""
+        with self._lock:
+            if flight.future is not failed:
+                return  # Another waiter already retried it
+            if flight.retried:
+                raise failed.exception()
+            flight.retried = True
+            self._replace_executor(flight.executor)
+            self._flights.setdefault(flight.key, flight)
+            self._start(flight)
+            self._update_gauges()
+
+    def wait(self, flight, timeout: float):
+        """
+        Wait for a flight's result. On timeout the caller stops waiting, and a
+        render nobody is waiting for any more is cancelled if it hasn't started.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            future = flight.future
+            try:
+                return future.result(timeout=max(0, deadline - time.monotonic()))
+            except BrokenProcessPool:
+                self._retry(flight, future)
+            except FutureTimeoutError:
+                self.release(flight)
+                raise
+
+    def release(self, flight):
+        """
+        Stop waiting for a flight without its result. A render nobody is
+        waiting for any more is cancelled if it hasn't started.
+        """
+        with self._lock:
+            flight.waiters -= 1
+            if flight.waiters == 0 and flight.future.cancel():
+                metrics.inc("render_cancelled_total")
+                logging.info(f"Cancelled queued render {flight.key}")
+
+    def render(self, key, fn, *args, timeout: float = 30):
+        """Submit and wait in one call."""
+        return self.wait(self.submit(key, fn, *args), timeout)
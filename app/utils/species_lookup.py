@@ -1,4 +1,18 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+
 import yaml
+import numpy as np
+
+from bisect import bisect_right
+
+SPECIES_DATA_FOLDER = "app/species_data"
+
+# How often (in seconds) the registry checks the species folder for edited files
+RELOAD_INTERVAL = float(os.getenv("SPECIES_RELOAD_INTERVAL", "2"))
 
 # Default ambiguous species data
 DEFAULT_DATA = {
@@ -21,12 +35,233 @@ DEFAULT_DATA = {
 }
 
 
+class HeightModel:
+    """
+    Precompiled anthro-to-feral height model for one species and gender.
+
+    Piecewise-linear through the data points, sorted by anthro size, with
+    the first and last segments extended past the data. With two points
+    that's the same straight line the old least-squares fit gave.
+    """
+
+    def __init__(self, gender_data: dict):
+        self.image = gender_data["image"]
+        self.ears_offset = gender_data["ears_offset"]
+        self.color = gender_data.get("color")
+
+        # Gather height and anthro size data, averaging points that share an anthro size
+        points = {}
+        for point in gender_data["data"]:
+            points.setdefault(float(point["anthro_size"]), []).append(point["height"])
+        self.anthro_sizes = sorted(points)
+        self.heights = [float(np.mean(points[size])) for size in self.anthro_sizes]
+        if len(self.anthro_sizes) < 2:
+            raise ValueError("Height data needs at least two distinct anthro sizes")
+
+        # One line per segment, segment i covers anthro sizes from breakpoints[i - 1] up to breakpoints[i]
+        self.breakpoints = self.anthro_sizes[1:-1]
+        self.slopes = []
+        self.intercepts = []
+        for x0, y0, x1, y1 in zip(
+            self.anthro_sizes, self.heights, self.anthro_sizes[1:], self.heights[1:]
+        ):
+            slope = (y1 - y0) / (x1 - x0)
+            self.slopes.append(slope)
+            self.intercepts.append(y0 - slope * x0)
+
+    def feral_height(self, anthro_height: float) -> float:
+        segment = bisect_right(self.breakpoints, anthro_height)
+        return self.slopes[segment] * anthro_height + self.intercepts[segment]
+
+
+class HeightTable:
+    """
+    Every loaded height model packed into NumPy coefficient arrays, so the
+    feral heights of a whole lineup are evaluated in one vectorized pass.
+    Rows are models, columns are segments (padded with the last segment).
+    """
+
+    def __init__(self, models: list):
+        self.models = models
+
+        segments = max(len(model.slopes) for model in models)
+        self.breakpoints = np.full((len(models), segments - 1), np.inf)
+        self.slopes = np.empty((len(models), segments))
+        self.intercepts = np.empty((len(models), segments))
+        for row, model in enumerate(models):
+            count = len(model.slopes)
+            self.breakpoints[row, : count - 1] = model.breakpoints
+            self.slopes[row, :count] = model.slopes
+            self.slopes[row, count:] = model.slopes[-1]
+            self.intercepts[row, :count] = model.intercepts
+            self.intercepts[row, count:] = model.intercepts[-1]
+
+    def feral_heights(self, rows, anthro_heights) -> np.ndarray:
+        """Feral height for each (model row, anthro height) pair."""
+        rows = np.asarray(rows, dtype=np.intp)
+        anthro_heights = np.asarray(anthro_heights, dtype=float)
+
+        # Same segment choice as bisect_right: how many breakpoints are at or below the height
+        segments = (anthro_heights[:, None] >= self.breakpoints[rows]).sum(axis=1)
+        return (
+            self.slopes[rows, segments] * anthro_heights
+            + self.intercepts[rows, segments]
+        )
+
+
+def fallback_model_key(species_models: dict, species_name, gender):
+    """
+    The (species, gender) whose model stands in for a species and gender.
+    Unknown species, and species without a usable model, fall back to the
+    default data (species None). A missing gender (ex. androgynous) falls
+    back to male.
+    """
+    models = species_models.get(species_name)
+    if not models or (gender not in models and "male" not in models):
+        species_name, models = None, species_models[None]
+    return species_name, gender if gender in models else "male"
+
+
+class SpeciesRegistry:
+    """
+    Process-wide registry of every species file in the species data folder.
+
+    Files are parsed once and their height models fitted on load. Every
+    `RELOAD_INTERVAL` seconds the folder is rescanned and only files whose
+    mtime changed are parsed again, so YAML edits show up without a restart.
+    """
+
+    def __init__(self, folder=SPECIES_DATA_FOLDER, reload_interval=RELOAD_INTERVAL):
+        self.folder = folder
+        self.reload_interval = reload_interval
+
+        self._lock = threading.Lock()
+        self._data = {}  # species -> raw yaml dict
+        # species -> {gender: HeightModel}, the default data's models under None
+        self._models = {None: self._compile(DEFAULT_DATA)}
+        self._mtimes = {}  # species -> mtime of the loaded file
+        self._last_scan = 0.0
+        # (HeightTable, species -> {gender: row}), rebuilt after changes
+        self._table = None
+
+    @staticmethod
+    def _compile(data) -> dict:
+        models = {}
+        if not isinstance(data, dict):
+            return models
+        for gender, gender_data in data.items():
+            if isinstance(gender_data, dict) and "data" in gender_data:
+                models[gender] = HeightModel(gender_data)
+        return models
+
+    def _scan(self):
+        """Reload any species file that was added, edited or removed."""
+        seen = set()
+        try:
+            entries = list(os.scandir(self.folder))
+        except FileNotFoundError:
+            entries = []
+
+        for entry in entries:
+            if not entry.name.endswith(".yaml"):
+                continue
+            species = entry.name[: -len(".yaml")]
+            seen.add(species)
+
+            mtime = entry.stat().st_mtime
+            if self._mtimes.get(species) == mtime:
+                continue
+
+            try:
+                with open(entry.path, "r") as file:
+                    data = yaml.safe_load(file)
+                models = self._compile(data)
+            except Exception as e:
+                logging.warning(f"Could not load species file {entry.path}: {e}")
+                continue
+
+            if species in self._mtimes:
+                logging.info(f"Reloaded species data for {species}")
+            self._data[species] = data
+            self._models[species] = models
+            self._mtimes[species] = mtime
+            self._table = None
+
+        for species in set(self._mtimes) - seen:
+            logging.info(f"Species data for {species} was removed")
+            del self._data[species]
+            del self._models[species]
+            del self._mtimes[species]
+            self._table = None
+
+    def refresh(self, force: bool = False):
+        """Rescan the species folder if the reload interval has passed."""
+        now = time.monotonic()
+        if not force and now - self._last_scan < self.reload_interval:
+            return
+        with self._lock:
+            if not force and now - self._last_scan < self.reload_interval:
+                return
+            self._scan()
+            self._last_scan = time.monotonic()
+
+    def get_data(self, species_name: str) -> dict:
+        """Returns the raw species data, or the default data if the species is unknown."""
+        self.refresh()
+        return self._data.get(species_name, DEFAULT_DATA)
+
+    def get_model(self, species_name: str, gender: str) -> HeightModel:
+        """
+        Returns the height model for a species and gender, see
+        `fallback_model_key` for what stands in for missing ones.
+        """
+        self.refresh()
+        species_name, gender = fallback_model_key(self._models, species_name, gender)
+        return self._models[species_name][gender]
+
+    def height_table(self):
+        """
+        Returns (HeightTable, lookup) for every loaded model, where
+        `lookup(species, gender)` gives the table row `get_model` would pick.
+        """
+        self.refresh()
+        table = self._table
+        if table is None:
+            with self._lock:
+                if self._table is None:
+                    models = []
+                    rows = {}
+                    for species, species_models in self._models.items():
+                        rows[species] = {}
+                        for gender, model in species_models.items():
+                            rows[species][gender] = len(models)
+                            models.append(model)
+                    self._table = (HeightTable(models), rows)
+                table = self._table
+
+        height_table, rows = table
+
+        def lookup(species_name, gender):
+            species_name, gender = fallback_model_key(rows, species_name, gender)
+            return rows[species_name][gender]
+
+        return height_table, lookup
+
+    def revision(self) -> str:
+        """Short hash of every loaded file and its mtime, changes whenever species data does."""
+        self.refresh()
+        digest = hashlib.sha256()
+        for species, mtime in sorted(self._mtimes.items()):
+            digest.update(f"{species}:{mtime};".encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    def species_names(self) -> list:
+        self.refresh()
+        return sorted(self._data)
+
+
+registry = SpeciesRegistry()
+
+
 def load_species_data(species_name):
-    try:
-        file_path = f"app/species_data/{species_name}.yaml"
-        with open(file_path, "r") as file:
-            data = yaml.safe_load(file)
-        return data
-    except FileNotFoundError:
-        # Return default ambiguous data if species file is not found
-        return DEFAULT_DATA
+    return registry.get_data(species_name)
@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from collections import OrderedDict
+from functools import lru_cache
+
+from PIL import Image
+
+ART_ROOT = "art"
+DIST_ROOT = os.path.join(ART_ROOT, "dist")
+MIP_ROOT = os.path.join(DIST_ROOT, "mip")
+MANIFEST_PATH = os.path.join(DIST_ROOT, "manifest.json")
+
+# Upper bound on decoded sprite memory per process
+SPRITE_CACHE_BYTES = int(os.getenv("SPRITE_CACHE_BYTES", str(256 * 1024 * 1024)))
+
+# Upper bound on resized (and tinted) sprite layer memory per process
+LAYER_CACHE_BYTES = int(os.getenv("LAYER_CACHE_BYTES", str(128 * 1024 * 1024)))
+
+# How often (in seconds) the art folder is rescanned for the art revision
+ART_REVISION_INTERVAL = float(os.getenv("ART_REVISION_INTERVAL", "10"))
+
+_art_revision = (0.0, "")  # (scanned at, revision)
+_manifest = (None, {})  # (mtime, sprites)
+
+
+def resolve_art_path(rel_path, level=0):
+    """
+    Returns (path, mtime) for the trimmed image in art/dist/ if it exists, otherwise for art/.
+    A single stat per candidate answers both existence and freshness.
+    Levels above 0 are the 1/2**level downscales trim_art.py writes to art/dist/mip/.
+    """
+    if level:
+        roots = (os.path.join(MIP_ROOT, str(level)),)
+    else:
+        roots = (DIST_ROOT, ART_ROOT)
+    for root in roots:
+        path = os.path.join(root, rel_path)
+        try:
+            return path, os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError(f"No art found for {rel_path} (level {level})")
+
+
+def image_nbytes(image) -> int:
+    """Approximate decoded size of a PIL image, or the size of anything with `nbytes` (arrays, layers)."""
+    if hasattr(image, "nbytes"):
+        return image.nbytes
+    return image.width * image.height * len(image.getbands())
+
+
+class ImageCache:
+    """
+    Thread-safe LRU cache of decoded PIL images (or numpy arrays, compositor
+    layers and label masks), bounded by total decoded bytes.
+
+    Cached images are shared between renders and must be treated as read-only.
+    """
+
+    def __init__(self, max_bytes=SPRITE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (image, nbytes)
+
+        # Forked workers inherit the cache, but must not inherit a lock held at fork time
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key):
+        """Like `get`, without counting towards hit rates or recency."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def put(self, key, image):
+        nbytes = image_nbytes(image)
+        if nbytes > self.max_bytes:
+            # Too big to ever fit, don't flush everything else for it
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (image, nbytes)
+            self.current_bytes += nbytes
+
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+sprite_cache = ImageCache()
+layer_cache = ImageCache(LAYER_CACHE_BYTES)
+
+
+def load_sprite(rel_path, level=0):
+    """
+    Returns the decoded, RGBA-converted sprite for an art path, at a mip level.
+    Keyed by resolved path and mtime so re-trimmed art is picked up automatically.
+    """
+    path, mtime = resolve_art_path(rel_path, level)
+    key = (path, mtime)
+
+    sprite = sprite_cache.get(key)
+    if sprite is None:
+        logging.debug(f"Decoding sprite {path}")
+        with Image.open(path) as img:
+            sprite = img.convert("RGBA")
+        sprite_cache.put(key, sprite)
+    return sprite
+
+
+def sprite_manifest() -> dict:
+    """
+    Per-sprite metadata written by trim_art.py: trimmed size, alpha bbox,
+    dominant color, source hash and mip sizes. Reloaded when the file changes.
+    """
+    global _manifest
+
+    try:
+        mtime = os.stat(MANIFEST_PATH).st_mtime
+    except FileNotFoundError:
+        return {}
+    if _manifest[0] != mtime:
+        try:
+            with open(MANIFEST_PATH) as f:
+                _manifest = (mtime, json.load(f)["sprites"])
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Could not read sprite manifest: {e}")
+            return {}
+    return _manifest[1]
+
+
+def sprite_info(rel_path):
+    """Manifest entry for a sprite, or None if it isn't being served from a build."""
+    if not resolve_art_path(rel_path)[0].startswith(DIST_ROOT):
+        return None
+    return sprite_manifest().get(rel_path)
+
+
+def mip_level(rel_path, size) -> int:
+    """
+    The smallest built mip level of a sprite that is still at least `size`
+    (width, height), so resizing to `size` only ever downsamples.
+    """
+    target_width, target_height = max(size[0], 1), max(size[1], 1)
+
+    info = sprite_info(rel_path)
+    if info is not None:
+        # The manifest knows exactly which levels were built
+        level = 0
+        for mip, (width, height) in info["mips"].items():
+            if width >= target_width and height >= target_height:
+                level = max(level, int(mip))
+        return level
+
+    width, height = sprite_size(rel_path)
+    level = 0
+    while (width >> (level + 1)) >= target_width and (
+        height >> (level + 1)
+    ) >= target_height:
+        level += 1
+
+    # Not every level exists, tiny sprites and dev checkouts without a build have none
+    while level:
+        try:
+            resolve_art_path(rel_path, level)
+            break
+        except FileNotFoundError:
+            level -= 1
+    return level
+
+
+@lru_cache(maxsize=4096)
+def _image_size(path, mtime):
+    # Only reads the header, the pixel data is never decoded
+    with Image.open(path) as img:
+        return img.size
+
+
+def sprite_size(rel_path):
+    """
+    Returns (width, height) of a sprite without decoding it, for callers
+    that only need geometry. Comes from the manifest when there is one.
+    """
+    info = sprite_info(rel_path)
+    if info is not None:
+        return info["width"], info["height"]
+
+    path, mtime = resolve_art_path(rel_path)
+    sprite = sprite_cache.peek((path, mtime))
+    if sprite is not None:
+        return sprite.size
+    return _image_size(path, mtime)
+
+
+@lru_cache(maxsize=4096)
+def _dominant_color(path, mtime):
+    with Image.open(path) as img:
+        return img.convert("RGBA").resize((1, 1)).getpixel((0, 0))[:3]
+
+
+def sprite_dominant_color(rel_path):
+    """Average color of a sprite at full size, from the manifest or cached by (path, mtime)."""
+    info = sprite_info(rel_path)
+    if info is not None:
+        return tuple(info["dominant_color"])
+    return _dominant_color(*resolve_art_path(rel_path))
+
+
+def art_revision() -> str:
+    """
+    Short hash of every art file and its mtime, rescanned at most every `ART_REVISION_INTERVAL` seconds.
+    """
+    global _art_revision
+
+    scanned_at, revision = _art_revision
+    now = time.monotonic()
+    if revision and now - scanned_at < ART_REVISION_INTERVAL:
+        return revision
+
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(ART_ROOT):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            digest.update(f"{path}:{mtime};".encode("utf-8"))
+
+    revision = digest.hexdigest()[:16]
+    _art_revision = (now, revision)
+    return revision
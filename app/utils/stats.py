@@ -1,27 +1,114 @@
 import os
+import atexit
 import sqlite3
 import logging
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
 
 # Default database location
 DEFAULT_DB_PATH = "/tmp/size-diff/stats.db"
 
+# How often buffered counters are written to the database, in seconds
+FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "5"))
+
+# How long `get_stats` reuses its last read of the database, in seconds
+SNAPSHOT_TTL = float(os.getenv("STATS_SNAPSHOT_TTL", "5"))
+
+# Days of per-IP visitor rows to keep before compacting them into the stats table
+VISITOR_RETENTION_DAYS = int(os.getenv("VISITOR_RETENTION_DAYS", "2"))
+
+# How often old visitor rows are compacted, in seconds
+COMPACT_INTERVAL = float(os.getenv("STATS_COMPACT_INTERVAL", "3600"))
+
+# Upper bound on IPs remembered in memory per day, past it dedup falls through to the database
+SEEN_VISITORS_LIMIT = int(os.getenv("SEEN_VISITORS_LIMIT", "100000"))
+
 
 class StatsManager:
-    def __init__(self, db_path=DEFAULT_DB_PATH):
+    """
+    Daily usage counters, buffered in memory and written behind.
+
+    Counter updates only touch an in-process buffer. A background thread
+    flushes the buffered deltas in a single transaction every
+    `FLUSH_INTERVAL` seconds (and once more at exit), over one persistent
+    WAL-mode connection per process, so workers stop fighting over the
+    sqlite write lock on every request.
+
+    Visitors are deduplicated per (day, ip). IPs already seen today are
+    skipped in memory, and rows older than `VISITOR_RETENTION_DAYS` are
+    compacted into the daily `stats` row and deleted, so storage stays flat.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, flush_interval=FLUSH_INTERVAL):
         if os.getenv("GIT_COMMIT"):
             self.db_path = db_path
         else:
             # Else we're running default/debug mode
             self.db_path = DEFAULT_DB_PATH
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()  # Guards the pending buffers and snapshot
+        self._db_lock = threading.Lock()  # Serializes use of the shared connection
+        self._pid = None
+        self._conn = None
+
+        self._pending_images = {}  # date -> images generated since last flush
+        self._pending_visitors = set()  # (date, ip) seen since last flush
+        self._seen_date = None
+        self._seen_visitors = set()  # ips already recorded for `_seen_date`
+        self._last_compact = 0.0
+
+        self._snapshot = None
+        self._snapshot_date = None
+        self._snapshot_at = 0.0
 
         self._initialize_db()
+        atexit.register(self.flush)
+
+    def _ensure_process(self):
+        """
+        (Re)creates per-process state. Buffers, the connection and the flush
+        thread don't survive a fork, so a forked worker starts its own.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self._conn = None
+            self._pending_images = {}
+            self._pending_visitors = set()
+            self._seen_visitors = set()
+            threading.Thread(
+                target=self._flush_loop, name="stats-flush", daemon=True
+            ).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            if time.monotonic() - self._last_compact > COMPACT_INTERVAL:
+                self._last_compact = time.monotonic()
+                self.compact_visitors()
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.db_path, timeout=10, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        return self._conn
 
     def _initialize_db(self):
         """Initialize the database and table if it doesn't already exist."""
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
             # Create the stats table with unique visitor IPs and date tracking
             cursor.execute(
                 """
@@ -34,12 +121,31 @@ class StatsManager:
             )
             cursor.execute(
                 """
-                CREATE TABLE IF NOT EXISTS visitors (
-                    ip TEXT PRIMARY KEY,
-                    date TEXT
-                )
+                CREATE TABLE IF NOT EXISTS daily_visitors (
+                    date TEXT,
+                    ip TEXT,
+                    PRIMARY KEY (date, ip)
+                ) WITHOUT ROWID
             """
             )
+            # The old table kept one row per IP forever, its counts already live in `stats`.
+            # Carry over the rows still inside the retention window first, so visitors
+            # already counted on deploy day aren't counted again
+            if cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'visitors'"
+            ).fetchone():
+                cutoff = (
+                    datetime.now() - timedelta(days=VISITOR_RETENTION_DAYS)
+                ).strftime("%Y-%m-%d")
+                cursor.execute(
+                    """
+                    INSERT OR IGNORE INTO daily_visitors (date, ip)
+                    SELECT date, ip FROM visitors WHERE date >= ?
+                """,
+                    (cutoff,),
+                )
+                logging.info(f"Migrated {cursor.rowcount} visitor rows")
+                cursor.execute("DROP TABLE visitors")
             # Ensure an entry for today exists
             today = datetime.now().strftime("%Y-%m-%d")
             cursor.execute(
@@ -53,60 +159,162 @@ class StatsManager:
 
     def increment_images_generated(self):
         """Increment the images generated count for the current day."""
+        self._ensure_process()
         today = datetime.now().strftime("%Y-%m-%d")
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                UPDATE stats SET images_generated = images_generated + 1
-                WHERE date = ?
-            """,
-                (today,),
-            )
-            conn.commit()
+        with self._lock:
+            self._pending_images[today] = self._pending_images.get(today, 0) + 1
 
     def register_visitor(self, ip_address: str):
+        """Register a unique visitor based on IP for the current day."""
+        self._ensure_process()
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self._lock:
+            if self._seen_date != today:
+                self._seen_date = today
+                self._seen_visitors = set()
+            if ip_address in self._seen_visitors:
+                return  # Already counted today, skip the database entirely
+            if len(self._seen_visitors) < SEEN_VISITORS_LIMIT:
+                self._seen_visitors.add(ip_address)
+            self._pending_visitors.add((today, ip_address))
+
+    def flush(self):
+        """Write all buffered counter deltas to the database in one transaction."""
+        if self._pid != os.getpid():
+            return  # Nothing buffered in this process
+
+        with self._lock:
+            images = self._pending_images
+            visitors = self._pending_visitors
+            self._pending_images = {}
+            self._pending_visitors = set()
+
+        if not images and not visitors:
+            return
+
         try:
-            """Register a unique visitor based on IP for the current day."""
-            today = datetime.now().strftime("%Y-%m-%d")
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                try:
-                    # Attempt to insert new visitor record; if it fails, the IP already exists for today
+            with self._db_lock:
+                conn = self._connection()
+                with conn:
+                    cursor = conn.cursor()
+                    for date in set(images) | {date for date, _ in visitors}:
+                        cursor.execute(
+                            """
+                            INSERT OR IGNORE INTO stats (date, unique_visitors, images_generated)
+                            VALUES (?, 0, 0)
+                        """,
+                            (date,),
+                        )
+
+                    new_visitors = {}
+                    for date, ip in visitors:
+                        # Rows that already exist were counted by another worker
+                        cursor.execute(
+                            "INSERT OR IGNORE INTO daily_visitors (date, ip) VALUES (?, ?)",
+                            (date, ip),
+                        )
+                        if cursor.rowcount:
+                            new_visitors[date] = new_visitors.get(date, 0) + 1
+
+                    for date in set(images) | set(new_visitors):
+                        cursor.execute(
+                            """
+                            UPDATE stats SET
+                                images_generated = images_generated + ?,
+                                unique_visitors = unique_visitors + ?
+                            WHERE date = ?
+                        """,
+                            (images.get(date, 0), new_visitors.get(date, 0), date),
+                        )
+        except Exception as e:
+            logging.warning(f"Got uncaught exception {e} when flushing stats!")
+
+            # Put the deltas back so the next flush can retry them
+            with self._lock:
+                for date, count in images.items():
+                    self._pending_images[date] = (
+                        self._pending_images.get(date, 0) + count
+                    )
+                self._pending_visitors |= visitors
+
+    def compact_visitors(self):
+        """
+        Fold visitor rows older than the retention window into their daily
+        `stats` row and delete them.
+        """
+        self._ensure_process()
+        cutoff = (datetime.now() - timedelta(days=VISITOR_RETENTION_DAYS)).strftime(
+            "%Y-%m-%d"
+        )
+        try:
+            with self._db_lock:
+                conn = self._connection()
+                with conn:
+                    cursor = conn.cursor()
                     cursor.execute(
-                        "INSERT INTO visitors (ip, date) VALUES (?, ?)",
-                        (ip_address, today),
+                        """
+                        INSERT OR IGNORE INTO stats (date, unique_visitors, images_generated)
+                        SELECT DISTINCT date, 0, 0 FROM daily_visitors WHERE date < ?
+                    """,
+                        (cutoff,),
                     )
                     cursor.execute(
                         """
-                        UPDATE stats SET unique_visitors = unique_visitors + 1
-                        WHERE date = ?
+                        UPDATE stats SET unique_visitors = MAX(
+                            unique_visitors,
+                            (SELECT COUNT(*) FROM daily_visitors WHERE daily_visitors.date = stats.date)
+                        )
+                        WHERE date < ?
                     """,
-                        (today,),
+                        (cutoff,),
+                    )
+                    cursor.execute(
+                        "DELETE FROM daily_visitors WHERE date < ?", (cutoff,)
                     )
-                except sqlite3.IntegrityError as e:
-                    # IP is already recorded for today; no need to update unique_visitors
-                    logging.warn(f"Integrity error {e} when recording IP")
-                    pass
-                conn.commit()
+                    if cursor.rowcount:
+                        logging.info(
+                            f"Compacted {cursor.rowcount} visitor rows older than {cutoff}"
+                        )
         except Exception as e:
-            logging.warn(f"Got uncaught exception {e} when saving visitor stat!")
+            logging.warning(f"Got uncaught exception {e} when compacting visitors!")
 
     def get_stats(self):
         """Retrieve current statistics for today."""
+        self._ensure_process()
         today = datetime.now().strftime("%Y-%m-%d")
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT unique_visitors, images_generated FROM stats WHERE date = ?",
-                (today,),
+        now = time.monotonic()
+
+        with self._lock:
+            snapshot_fresh = (
+                self._snapshot is not None
+                and self._snapshot_date == today
+                and now - self._snapshot_at < SNAPSHOT_TTL
             )
-            stats = cursor.fetchone()
-            if stats:
-                return {
-                    "unique_visitors": stats[0],
-                    "images_generated": stats[1],
-                }
-            else:
-                # If no entry for today, return zeros
-                return {"unique_visitors": 0, "images_generated": 0}
+
+        if not snapshot_fresh:
+            with self._db_lock:
+                cursor = self._connection().cursor()
+                cursor.execute(
+                    "SELECT unique_visitors, images_generated FROM stats WHERE date = ?",
+                    (today,),
+                )
+                stats = cursor.fetchone()
+            with self._lock:
+                if stats:
+                    self._snapshot = {
+                        "unique_visitors": stats[0],
+                        "images_generated": stats[1],
+                    }
+                else:
+                    # If no entry for today, return zeros
+                    self._snapshot = {"unique_visitors": 0, "images_generated": 0}
+                self._snapshot_date = today
+                self._snapshot_at = now
+
+        with self._lock:
+            # Include this process's not yet flushed images so the count never lags
+            return {
+                "unique_visitors": self._snapshot["unique_visitors"],
+                "images_generated": self._snapshot["images_generated"]
+                + self._pending_images.get(today, 0),
+            }
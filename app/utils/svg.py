@@ -0,0 +1,172 @@
+import os
+
+from urllib.parse import quote
+from xml.sax.saxutils import escape, quoteattr
+
+from app.utils.calculate_heights import inches_to_feet_inches
+from app.utils.generate_image import clip_label, label_color
+from app.utils.layout import compute_layout
+from app.utils.metrics import PhaseTimer
+from app.utils.sprite_cache import (
+    MIP_ROOT,
+    DIST_ROOT,
+    mip_level,
+    resolve_art_path,
+)
+
+# Where browsers fetch sprites from, point it at a CDN to serve them from there. Unset,
+# the app links the requesting host's /sprites/, so SVGs still work saved or embedded elsewhere
+SPRITE_URL_PREFIX = os.getenv("SPRITE_URL_PREFIX", "")
+
+# Used outside a request, e.g. when rendering from a script
+DEFAULT_SPRITE_URL_PREFIX = "/sprites/"
+
+FONT_FAMILY = "'Open Sans', sans-serif"
+
+
+def sprite_url(rel_path, size=None, prefix=None) -> str:
+    """
+    Long-cacheable URL of a sprite, versioned by its mtime so re-trimmed art
+    busts caches. With a `size`, points at the smallest mip level that still
+    covers it at 2x, so high-DPI screens stay sharp.
+    """
+    level = mip_level(rel_path, (size[0] * 2, size[1] * 2)) if size else 0
+    _, mtime = resolve_art_path(rel_path, level)
+    if level:
+        mip_prefix = os.path.relpath(MIP_ROOT, DIST_ROOT)
+        rel_path = f"{mip_prefix}/{level}/{rel_path}"
+    prefix = prefix or SPRITE_URL_PREFIX or DEFAULT_SPRITE_URL_PREFIX
+    return f"{prefix}{quote(rel_path)}?v={int(mtime)}"
+
+
+def _hex(color) -> str:
+    return "#{:02x}{:02x}{:02x}".format(*color[:3])
+
+
+def _text(x, y, lines, font_size, fill) -> str:
+    """Multi-line label, positioned by its top left corner like ImageDraw.text."""
+    tspans = "".join(
+        f'<tspan x="{x}" dy="{0 if i == 0 else 1.2}em">{escape(clip_label(line))}</tspan>'
+        for i, line in enumerate(lines)
+    )
+    return (
+        f'<text x="{x}" y="{y}" font-size="{font_size}" fill="{fill}" '
+        f'dominant-baseline="text-before-edge">{tspans}</text>'
+    )
+
+
+def placeholder_svg(size: int) -> str:
+    """Blank canvas for an empty lineup."""
+    width, height = int(size * 1.4), size
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}"><rect width="100%" height="100%" fill="white"/></svg>'
+    )
+
+
+def render_svg(
+    char_list,
+    size,
+    measure_to_ears: bool = True,
+    use_species_scaling: bool = False,
+    sprite_url_prefix=None,
+) -> str:
+    """
+    The same comparison as `render_image`, as SVG markup. Sprites are
+    referenced by URL instead of embedded, so the response stays a few KB and
+    browsers fetch (and cache) each sprite once. `sprite_url_prefix`
+    overrides where those URLs point.
+    """
+    timer = PhaseTimer()
+    layout = compute_layout(
+        char_list,
+        size,
+        measure_to_ears=measure_to_ears,
+        use_species_scaling=use_species_scaling,
+        timer=timer,
+    )
+    size = layout.size
+    font_size = layout.font_size
+
+    defs = {}  # tint color -> filter element
+    body = []
+
+    # Guidelines, offset half a pixel so 1px strokes land on a pixel row
+    for y_pos in layout.guidelines:
+        body.append(
+            f'<line x1="0" y1="{y_pos + 0.5}" x2="{layout.width}" y2="{y_pos + 0.5}" '
+            f'stroke="grey" stroke-width="1"/>'
+        )
+
+    for box in layout.boxes:
+        char = box.char
+        href = quoteattr(
+            sprite_url(char.image, (box.width, box.height), sprite_url_prefix)
+        )
+
+        fill = _hex(label_color(char.image, char.color))
+        if char.color:
+            # Same effect as apply_color_shift: flood the sprite's shape with the tint color
+            filter_id = f"tint-{char.color.lower()}"
+            defs[filter_id] = (
+                f'<filter id="{filter_id}"><feFlood flood-color="#{char.color}"/>'
+                f'<feComposite in2="SourceAlpha" operator="in"/></filter>'
+            )
+            body.append(
+                f'<image href={href} x="{box.x}" y="{box.y}" width="{box.width}" '
+                f'height="{box.height}" preserveAspectRatio="none" filter="url(#{filter_id})"/>'
+            )
+        else:
+            body.append(
+                f'<image href={href} x="{box.x}" y="{box.y}" width="{box.width}" '
+                f'height="{box.height}" preserveAspectRatio="none"/>'
+            )
+
+        if box.height_line_y is not None:
+            # Same dashes as draw_dotted_line
+            dash_length = int((40 * size) / 1024)
+            gap = int((20 * size) / 1024)
+            width = int((8 * size) / 1024)
+            body.append(
+                f'<line x1="{box.x}" y1="{box.height_line_y}" x2="{box.x + box.width}" '
+                f'y2="{box.height_line_y}" stroke="{fill}" stroke-width="{width}" '
+                f'stroke-dasharray="{dash_length} {gap}"/>'
+            )
+
+        # Character's name and height
+        lines = [inches_to_feet_inches(char.feral_height), char.get_species_name()]
+        if char.height != char.feral_height:
+            lines.append(f"({inches_to_feet_inches(char.height)})")
+        body.append(
+            _text(
+                box.label_x,
+                box.label_y - (font_size + 5),
+                [char.name],
+                font_size,
+                fill,
+            )
+        )
+        body.append(_text(box.label_x, box.label_y, lines, font_size, fill))
+
+    # This is ONLY to denote the development image
+    if os.getenv("DEBUG", False):
+        body.append(
+            _text(
+                0,
+                size,
+                [f"DEVELOPMENT VERSION {os.getenv('GIT_COMMIT', '')}  " * 20],
+                font_size,
+                "rgb(128,0,30)",
+            )
+        )
+
+    timer.observe()
+
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{layout.width}" '
+        f'height="{layout.height}" viewBox="0 0 {layout.width} {layout.height}" '
+        f'font-family="{FONT_FAMILY}">'
+        f'<defs>{"".join(defs.values())}</defs>'
+        f'<rect width="100%" height="100%" fill="white"/>'
+        f'{"".join(body)}</svg>'
+    )
@@ -0,0 +1,60 @@
+"""
+Gunicorn settings, used by the Docker image:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is loaded and its caches warmed once in the master, before any
+worker is forked, so every worker starts warm and shares the loaded
+species data, fonts and decoded sprites copy-on-write.
+"""
+
+import gc
+import os
+import time
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+# Import the app in the master so the warm-up below happens once, pre-fork
+preload_app = True
+
+_started = time.monotonic()
+
+
+def when_ready(server):
+    """Runs in the master after the app is loaded, before the first worker is forked."""
+    from app.utils.metrics import metrics
+    from app.utils.render_backend import warm_caches
+
+    warm_caches()
+
+    # Warm-up recorded metrics, which started a writer thread. Stop it before forking,
+    # a thread caught mid-snapshot would leave cache locks held in every worker
+    metrics.stop()
+
+    # Move everything loaded so far out of the collector's reach, so collections
+    # in the workers don't write to (and un-share) those pages
+    gc.collect()
+    gc.freeze()
+
+    server.log.info(
+        f"Ready to fork {workers} workers, startup took {time.monotonic() - _started:.2f}s"
+    )
+
+
+def post_worker_init(worker):
+    from app import cache_warmer
+
+    # Warm the render cache right away instead of on the first request
+    cache_warmer.start()
+
+    worker.log.info(f"Worker {worker.pid} booted")
+
+
+def child_exit(server, worker):
+    """Runs in the master once a worker has exited, before its replacement is forked."""
+    from app.utils.metrics import metrics
+
+    # Fold its metrics into the retired totals now, before anything can reuse its pid
+    metrics.retire(pid=worker.pid)
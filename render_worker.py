@@ -0,0 +1,40 @@
+"""
+Entry points of the process-pool render workers (RENDER_BACKEND=process).
+
+Render processes only need `app.utils`. Importing it the usual way would run
+`app/__init__.py`, building the Flask app and the StatsManager (and its
+database migrations) in every render process. So the `app` package is
+registered here as a bare namespace first, and only the modules a render
+actually uses get imported.
+
+In a web worker `app` is already imported, and these are plain wrappers.
+"""
+
+import os
+import sys
+import types
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+
+
+def _bare_app_package():
+    if "app" not in sys.modules:
+        package = types.ModuleType("app")
+        package.__path__ = [APP_DIR]
+        sys.modules["app"] = package
+
+
+def warm_render_process():
+    """Initializer for render processes, they start with nothing cached."""
+    _bare_app_package()
+    from app.utils.render_backend import warm_caches
+
+    warm_caches()
+
+
+def render_spec(spec) -> bytes:
+    """Renders one (canonical query string, format) spec, see render_backend.render_spec."""
+    _bare_app_package()
+    from app.utils import render_backend
+
+    return render_backend.render_spec(spec)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the renderer and the /generate-image request path.
+
+Times calculate_height_offset, extract_characters, render_image across a
+matrix of character counts, sizes, flags and tinted vs untinted species,
+and full requests through Flask's test client. Results are written as
+JSON. With --baseline, exits non-zero if any benchmark's median got more
+than --threshold slower than the stored run.
+
+    python3 scripts/benchmark.py --output bench.json
+    python3 scripts/benchmark.py --baseline bench.json --threshold 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+INVOCATION_DIR = Path.cwd()
+
+# Paths in the app are relative to the repo root
+os.chdir(REPO_ROOT)
+sys.path.insert(0, str(REPO_ROOT))
+
+# Keep benchmark renders out of the real render cache and metrics
+_scratch = tempfile.mkdtemp(prefix="size-diff-bench-")
+os.environ.setdefault("RENDER_CACHE_DIR", os.path.join(_scratch, "render-cache"))
+os.environ.setdefault("METRICS_DIR", os.path.join(_scratch, "metrics"))
+os.environ.setdefault("CACHE_WARM_INTERVAL", "0")
+
+from app.utils.character import Character
+from app.utils.calculate_heights import (
+    calculate_height_offset,
+    calculate_height_offsets,
+)
+from app.utils.parse_data import extract_characters, generate_characters_query_string
+from app.utils.generate_image import render_image, label_cache
+from app.utils.compositor import guideline_cache
+from app.utils.sprite_cache import sprite_cache, layer_cache
+
+# Species with a `color` key are tinted, the others are pasted as-is
+TINTED_SPECIES = ["taur_(generic)", "canine", "feline", "mouse"]
+UNTINTED_SPECIES = ["wolf", "equine", "giraffe", "arctic_fox"]
+
+CHARACTER_COUNTS = [1, 2, 6, 12, 25, 50]
+SIZES = [100, 400, 1024, 2048]
+QUICK_CHARACTER_COUNTS = [1, 6, 25]
+QUICK_SIZES = [100, 1024]
+
+
+def make_characters(count: int, tinted: bool) -> list:
+    species = TINTED_SPECIES if tinted else UNTINTED_SPECIES
+    genders = ["male", "female"]
+    return [
+        Character(
+            name=f"C{i}",
+            species=species[i % len(species)],
+            height=48 + (i * 7) % 60,
+            gender=genders[i % 2],
+        )
+        for i in range(count)
+    ]
+
+
+def time_it(func, repeat: int, warmup: int = 1) -> dict:
+    """Runs `func` `warmup` times untimed, then `repeat` times timed."""
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "max": max(samples),
+        "repeat": repeat,
+    }
+
+
+def clear_image_caches():
+    """Drops every decoded sprite, resized layer, label mask and guideline background."""
+    sprite_cache.clear()
+    layer_cache.clear()
+    label_cache.clear()
+    guideline_cache.clear()
+
+
+def bench_height_offset(results, repeat):
+    chars = make_characters(50, tinted=True) + make_characters(50, tinted=False)
+
+    def run():
+        for char in chars:
+            calculate_height_offset(char, use_species_scaling=True)
+
+    results["calculate_height_offset[100 chars]"] = time_it(run, repeat)
+    results["calculate_height_offsets[100 chars]"] = time_it(
+        lambda: calculate_height_offsets(chars, use_species_scaling=True), repeat
+    )
+
+
+def bench_extract_characters(results, repeat, counts):
+    for count in counts:
+        query = generate_characters_query_string(make_characters(count, tinted=False))
+        results[f"extract_characters[n={count}]"] = time_it(
+            lambda: extract_characters(query), repeat
+        )
+
+
+def bench_render_image(results, repeat, counts, sizes):
+    # Scaling with character count and size, default flags
+    for count in counts:
+        for size in sizes:
+            for tinted in (False, True):
+                chars = make_characters(count, tinted)
+                results[f"render_image[n={count},size={size},tinted={tinted}]"] = (
+                    time_it(lambda: render_image(chars, size), repeat)
+                )
+
+                # Cold: sprite decode, mip resize, tinting and label rasterization every sample
+                def cold():
+                    clear_image_caches()
+                    render_image(chars, size)
+
+                results[f"render_image[n={count},size={size},tinted={tinted},cold]"] = (
+                    time_it(cold, repeat)
+                )
+
+    # Flag combinations on a mid-sized lineup
+    chars = make_characters(6, tinted=True)
+    for measure_to_ears in (False, True):
+        for use_species_scaling in (False, True):
+            results[
+                f"render_image[n=6,size=1024,ears={measure_to_ears},scaling={use_species_scaling}]"
+            ] = time_it(
+                lambda: render_image(
+                    chars,
+                    1024,
+                    measure_to_ears=measure_to_ears,
+                    use_species_scaling=use_species_scaling,
+                ),
+                repeat,
+            )
+
+
+def bench_request(results, repeat, counts):
+    from app import app, render_cache
+    from app.utils.render_params import RenderParams
+
+    client = app.test_client()
+
+    for count in counts:
+        chars = make_characters(count, tinted=True)
+        params = RenderParams(chars, 1024, True, False, "png")
+        url = f"/generate-image?{params.query_string()}"
+
+        # Cold: nothing cached, as after a deploy
+        def cold():
+            render_cache.clear()
+            clear_image_caches()
+            response = client.get(url)
+            assert response.status_code == 200, response.status_code
+
+        # Render cache miss, with this process's sprite, layer and label caches warm
+        def miss():
+            render_cache.clear()
+            response = client.get(url)
+            assert response.status_code == 200, response.status_code
+
+        # Warm: served from the render cache
+        def warm():
+            response = client.get(url)
+            assert response.status_code == 200, response.status_code
+
+        results[f"request[n={count},size=1024,cold]"] = time_it(cold, repeat)
+        results[f"request[n={count},size=1024,miss]"] = time_it(miss, repeat)
+        results[f"request[n={count},size=1024,warm]"] = time_it(warm, repeat)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Returns (name, baseline median, new median) for every regression."""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result["median"] > previous["median"] * (1 + threshold):
+            regressions.append((name, previous["median"], result["median"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="Previous results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown of a median vs the baseline (0.2 = 20%%)",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--quick", action="store_true", help="Smaller matrix, for a fast check"
+    )
+    args = parser.parse_args()
+
+    output_path = INVOCATION_DIR / args.output
+    counts = QUICK_CHARACTER_COUNTS if args.quick else CHARACTER_COUNTS
+    sizes = QUICK_SIZES if args.quick else SIZES
+
+    results = {}
+    bench_height_offset(results, args.repeat)
+    bench_extract_characters(results, args.repeat, counts)
+    bench_render_image(results, args.repeat, counts, sizes)
+    bench_request(results, args.repeat, counts)
+
+    for name, result in results.items():
+        print(f"{name:70s} {result['median'] * 1000:10.2f} ms")
+
+    with open(output_path, "w") as f:
+        json.dump(
+            {
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "git_commit": os.getenv("GIT_COMMIT", ""),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Wrote {len(results)} results to {output_path}")
+
+    if args.baseline:
+        with open(INVOCATION_DIR / args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            print(f"REGRESSION {name}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions past {args.threshold:.0%} vs {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
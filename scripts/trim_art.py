@@ -1,16 +1,49 @@
 #!/usr/bin/env python3
 import os
+import json
+import hashlib
+import tempfile
 from PIL import Image
 from pathlib import Path
-import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 ART_ROOT = Path("art")
 DIST_ROOT = ART_ROOT / "dist"
+MIP_ROOT = DIST_ROOT / "mip"
+MANIFEST_PATH = DIST_ROOT / "manifest.json"
 
+# Bump when the build output changes, so every sprite is rebuilt once
+MANIFEST_VERSION = 1
 
-def is_blank(pixel):
-    # For RGBA, blank means alpha == 0
-    return len(pixel) == 4 and pixel[3] == 0
+# Mip levels stop once a sprite would be shorter than this
+MIN_MIP_HEIGHT = 64
+
+
+def mip_path(rel_path, level):
+    return MIP_ROOT / str(level) / rel_path
+
+
+def mip_sizes(width, height):
+    """(level, size) of every power-of-two downscale, level n is 1/2**n."""
+    level = 1
+    while (height >> level) >= MIN_MIP_HEIGHT and (width >> level) >= 1:
+        yield level, (width >> level, height >> level)
+        level += 1
+
+
+def write_mips(trimmed, rel_path):
+    """
+    Writes the mip pyramid of a trimmed sprite. Every level is resampled from
+    full resolution, the renderer then only has to do a small final resize.
+    Returns {level: [width, height]}.
+    """
+    mips = {}
+    for level, size in mip_sizes(*trimmed.size):
+        dest_path = mip_path(rel_path, level)
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        trimmed.resize(size, Image.LANCZOS).save(dest_path)
+        mips[str(level)] = list(size)
+    return mips
 
 
 def trim_image(src_path, dest_path):
@@ -20,37 +53,103 @@ def trim_image(src_path, dest_path):
         trimmed = img.crop(bbox)
     else:
         trimmed = img  # fully blank? shouldn't happen
+        bbox = (0, 0, img.width, img.height)
     dest_path.parent.mkdir(parents=True, exist_ok=True)
     trimmed.save(dest_path)
+    return trimmed, bbox
 
 
-def should_trim(src, dest):
-    if not dest.exists():
-        return True
-    return os.path.getmtime(src) > os.path.getmtime(dest)
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
-def main():
-    trimmed = 0
-    skipped = 0
-    copied = 0
+def is_up_to_date(rel_path, entry, src_hash):
+    """The manifest entry was built from this exact file, and its outputs are all still there."""
+    if not entry or entry.get("hash") != src_hash:
+        return False
+    if entry.get("version") != MANIFEST_VERSION:
+        return False
+    if not (DIST_ROOT / rel_path).exists():
+        return False
+    return all(mip_path(rel_path, level).exists() for level in entry["mips"])
+
+
+def build_sprite(rel_path, src_hash):
+    """Trims one sprite, writes its mips and returns its manifest entry. Runs in a worker process."""
+    trimmed, bbox = trim_image(ART_ROOT / rel_path, DIST_ROOT / rel_path)
+    mips = write_mips(trimmed, rel_path)
+    return {
+        "version": MANIFEST_VERSION,
+        "hash": src_hash,
+        "width": trimmed.width,
+        "height": trimmed.height,
+        # Alpha bounding box in the source image, i.e. what was trimmed away
+        "bbox": list(bbox),
+        # Same 1x1 average the renderer used to compute per render
+        "dominant_color": list(trimmed.resize((1, 1)).getpixel((0, 0))[:3]),
+        "mips": mips,
+    }
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)["sprites"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def write_manifest(sprites):
+    """Written atomically, running workers may be reading it."""
+    DIST_ROOT.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=DIST_ROOT, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "sprites": sprites}, f, indent=1)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def find_sprites():
     for root, dirs, files in os.walk(ART_ROOT):
         # Skip the dist directory
         if DIST_ROOT in map(lambda d: Path(root) / d, dirs):
             dirs.remove("dist")
         for file in files:
-            if not file.lower().endswith(".png"):
-                continue
-            src_path = Path(root) / file
-            rel_path = src_path.relative_to(ART_ROOT)
-            dest_path = DIST_ROOT / rel_path
-            if should_trim(src_path, dest_path):
-                trim_image(src_path, dest_path)
-                print(f"Trimmed: {src_path} -> {dest_path}")
-                trimmed += 1
-            else:
-                skipped += 1
-    print(f"Done. Trimmed: {trimmed}, Skipped (up-to-date): {skipped}")
+            if file.lower().endswith(".png"):
+                yield (Path(root) / file).relative_to(ART_ROOT)
+
+
+def main():
+    old_manifest = load_manifest()
+    manifest = {}
+    pending = []
+    skipped = 0
+
+    # Hashing is cheap next to decoding, so it decides what actually needs a rebuild
+    for rel_path in sorted(find_sprites()):
+        key = rel_path.as_posix()
+        src_hash = file_hash(ART_ROOT / rel_path)
+        if is_up_to_date(rel_path, old_manifest.get(key), src_hash):
+            manifest[key] = old_manifest[key]
+            skipped += 1
+        else:
+            pending.append((rel_path, src_hash))
+
+    # Decoding, trimming and resampling are CPU bound, spread them over every core
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [
+            (rel_path, executor.submit(build_sprite, rel_path, src_hash))
+            for rel_path, src_hash in pending
+        ]
+        for rel_path, future in futures:
+            manifest[rel_path.as_posix()] = future.result()
+            print(f"Trimmed: {ART_ROOT / rel_path} -> {DIST_ROOT / rel_path}")
+
+    write_manifest(manifest)
+    print(f"Done. Trimmed: {len(pending)}, Skipped (up-to-date): {skipped}")
 
 
 if __name__ == "__main__":